@@ -0,0 +1,143 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def _len_prefix(value: str) -> bytes:
+    """
+    Encodes a string as <length>:<bytes> so concatenated fields can never collide
+    (e.g. ("ab", "c") and ("a", "bc") produce different keys).
+    """
+    data = value.encode("utf-8")
+    return str(len(data)).encode("ascii") + b":" + data
+
+
+def make_cache_key(model: str, prompt_version: str, page_url: str, content: str) -> str:
+    """
+    Builds a content-addressable key: identical (model, prompt, url, content) always map to the same entry.
+    """
+    digest = hashlib.sha256()
+    for part in (model, prompt_version, content, page_url):
+        digest.update(_len_prefix(part))
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    JSON-on-disk cache for LLM outputs, stored at `cache_dir/<key[:2]>/<key>.json`.
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Any | None:
+        """Returns the cached value for `key`, or None on a miss or unreadable entry."""
+        path = self._path(key)
+        try:
+            with path.open(encoding="utf-8") as f:
+                return json.load(f)["value"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("⚠️ Discarding unreadable cache entry %s: %s", path, e)
+            self.evict(key)
+            return None
+
+    def put(self, key: str, value: Any, meta: dict[str, Any] | None = None) -> None:
+        """Stores `value` under `key` along with optional metadata (model, prompt_version, ...)."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            "value": value,
+            **(meta or {}),
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        # Write to a temp file first so a crash never leaves a half-written entry behind. The name is
+        # unique per thread, since concurrent scrapers may store the same key (e.g. a shared widget).
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def evict(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+
+class UrlCategoryIndex:
+    """
+    Semantic cache of URL path -> categories, searched by cosine similarity over path embeddings.
+    Brute-force numpy search is plenty for the <10k paths a set of gym sitemaps produces.
+    Persisted as `index.json` (paths and labels) plus `embeddings.npy` inside `index_dir`.
+    """
+
+    def __init__(self, index_dir: str | os.PathLike, threshold: float = 0.92):
+        self.index_dir = Path(index_dir)
+        self.threshold = threshold
+        self.paths: list[str] = []
+        self.labels: list[list[str]] = []
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self._load()
+
+    def _load(self) -> None:
+        index_path = self.index_dir / "index.json"
+        embeddings_path = self.index_dir / "embeddings.npy"
+        if not index_path.exists() or not embeddings_path.exists():
+            return
+        try:
+            with index_path.open(encoding="utf-8") as f:
+                index = json.load(f)
+            embeddings = np.load(embeddings_path)
+        except (OSError, ValueError) as e:
+            log.warning("⚠️ Ignoring unreadable URL category index at %s: %s", self.index_dir, e)
+            return
+        if len(index["paths"]) != len(embeddings):
+            log.warning("⚠️ Ignoring inconsistent URL category index at %s", self.index_dir)
+            return
+        self.paths, self.labels, self.embeddings = index["paths"], index["labels"], embeddings
+
+    def save(self) -> None:
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with (self.index_dir / "index.json").open("w", encoding="utf-8") as f:
+            json.dump({"paths": self.paths, "labels": self.labels}, f, ensure_ascii=False)
+        np.save(self.index_dir / "embeddings.npy", self.embeddings)
+
+    def add(self, paths: list[str], embeddings: np.ndarray, labels: list[list[str]]) -> None:
+        """Adds categorized paths; embeddings are L2-normalized so search is a plain dot product."""
+        if not paths:
+            return
+        normalized = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        self.embeddings = normalized if not self.paths else np.vstack([self.embeddings, normalized])
+        self.paths.extend(paths)
+        self.labels.extend(labels)
+
+    def lookup(self, embeddings: np.ndarray) -> list[list[str] | None]:
+        """
+        For each query embedding, returns the labels of the nearest cached path if its
+        cosine similarity reaches the threshold, otherwise None.
+        """
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if not self.paths or not len(queries):
+            return [None] * len(queries)
+        similarities = _normalize_rows(queries) @ self.embeddings.T
+        best = similarities.argmax(axis=1)
+        return [
+            self.labels[j] if similarities[i, j] >= self.threshold else None
+            for i, j in enumerate(best)
+        ]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
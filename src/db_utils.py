@@ -1,3 +1,4 @@
+import logging
 import os
 
 import psycopg2
@@ -6,6 +7,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 def get_connection():
     return psycopg2.connect(
         dbname=os.getenv("PGDATABASE"),
@@ -87,7 +90,7 @@ def init_db(conn):
     with conn.cursor() as cur:
         cur.execute(create_tables)
         conn.commit()
-        print("✅ Tables ensured successfully")
+        log.info("✅ Tables ensured successfully")
 
 
 def get_or_create_gym_id(conn, gym_name: str) -> int:
@@ -161,4 +164,4 @@ def bulk_insert(conn, gym_name: str, merged_data: dict):
         """, disciplinas_data)
 
     conn.commit()
-    print(f"✅ Bulk inserted all data for gym: {gym_name} (id={gym_id})")
+    log.info("✅ Bulk inserted all data for gym: %s (id=%s)", gym_name, gym_id)
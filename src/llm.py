@@ -1,58 +1,90 @@
+import asyncio
+import contextlib
 import datetime
 import logging
+import re
+import time
 from collections import defaultdict
+from urllib.parse import urlparse
 
+import httpx
 import openai
 import json
-from typing import Any
+from typing import Any, Callable, Final
 
 from dotenv import load_dotenv
 from openai import OpenAI
-
-
-def _sanitize_and_generate_content(facts: list[dict], category: str) -> list[dict]:
-    """
-    Una función interna para sanitizar los hechos y generar el campo de contenido si falta.
-    Esta es nuestra red de seguridad contra las inconsistencias del LLM.
-    """
-    sanitized_facts = []
-    for fact in facts:
-        if not isinstance(fact, dict):
-            continue  # Ignorar elementos que no son diccionarios
-
-        # Si 'content_para_busqueda' falta o está vacío, lo generamos
-        if not fact.get("content_para_busqueda"):
-            logging.info(f"🛠️ Generando 'content_para_busqueda' faltante para un hecho de '{category}'.")
-            summary_parts = []
-            if category == "ubicaciones":
-                summary_parts.append(
-                    f"La sede se encuentra en {fact.get('direccion_completa', 'dirección no especificada')}")
-                if fact.get('distrito'):
-                    summary_parts.append(f"en el distrito de {fact.get('distrito')}.")
-            elif category == "precios":
-                summary_parts.append(f"Se ofrece un plan '{fact.get('descripcion_plan', 'no especificado')}'")
-                if fact.get('valor') is not None:
-                    summary_parts.append(f"por {fact.get('valor')} {fact.get('moneda', '')}.")
-            elif category == "horarios":
-                summary_parts.append(
-                    f"La clase '{fact.get('nombre_clase', 'no especificada')}' es impartida por {fact.get('instructor', 'instructor no especificado')}")
-                if fact.get('dia_semana'):
-                    summary_parts.append(
-                        f" el día {fact.get('dia_semana')} de {fact.get('hora_inicio', '')} a {fact.get('hora_fin', '')}.")
-                if fact.get('fecha'):
-                    summary_parts.append(f" en la fecha {fact.get('fecha')}.")
-            else:  # Fallback genérico
-                summary_parts.append(f"Dato de tipo '{category}': " + ", ".join(
-                    [f"{k}: {v}" for k, v in fact.items() if k != 'content_para_busqueda' and v]))
-
-            fact["content_para_busqueda"] = " ".join(summary_parts).strip()
-
-        sanitized_facts.append(fact)
-    return sanitized_facts
-
-
-def detect_schedule(client: OpenAI, html_text: str) -> bool:
-    prompt = f"""
+from pydantic import ValidationError
+
+from src.cache_utils import ExtractionCache, UrlCategoryIndex, make_cache_key
+from src.schemas import (
+    GYM_FACTS_BATCH_RESPONSE_FORMAT,
+    GYM_FACTS_RESPONSE_FORMAT,
+    GymFacts,
+    MergedGymData,
+    UrlCategorization,
+)
+from src.sitemap_utils import SitemapEntry
+from src.url_utils import fast_categorize_urls
+
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def _loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:
+    def _loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+    def _dumps(obj: Any) -> str:
+        # Compact like orjson: whitespace in prompts is paid for in tokens
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+MAX_CONCURRENT_REQUESTS = 20
+OPENAI_MAX_RETRIES = 4
+OPENAI_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# Failures that lose a single page/chunk instead of aborting the run: API errors that survived
+# the SDK retries, transport errors while reading a stream, and malformed model output
+RECOVERABLE_ERRORS = (openai.APIError, httpx.TransportError, json.JSONDecodeError)
+# Extra calls made when the output fails schema validation, each one re-posting the error to the model
+VALIDATION_MAX_RETRIES = 2
+# Bump these whenever a prompt changes so stale cache entries are not reused
+EXTRACTION_PROMPT_VERSION = "v5"
+CATEGORIZATION_PROMPT_VERSION = "v2"
+EXTRACTION_MODELS = "gpt-5-nano|gpt-5-mini-2025-08-07"
+CATEGORIZATION_MODEL = "gpt-4o-mini"
+CATEGORIZATION_CHUNK_SIZE = 200
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The embeddings endpoint accepts at most 2048 inputs per request
+EMBEDDING_BATCH_SIZE = 2048
+EXTRACTION_CATEGORIES = ["ubicaciones", "precios", "horarios", "disciplinas"]
+# The merge LLM call only runs if some category still has at least this many facts after exact dedup
+MERGE_LLM_MIN_FACTS = 2
+URL_CATEGORIES = ["locations", "pricing", "schedules", "disciplines"]
+# Input budget for the HTML sent to the model. Token counts are approximated from characters
+# (~3.5 chars per token for Spanish markup), which avoids a tokenizer dependency.
+MAX_HTML_TOKENS = 8000
+CHARS_PER_TOKEN = 3.5
+
+_NOISE_BLOCK_RE = re.compile(r"<(script|style|svg|noscript|iframe|nav|header|footer)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_DATA_URI_RE = re.compile(r"data:[\w/+.-]+;base64,[A-Za-z0-9+/=]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+# Escape pairs inside strings are consumed whole; a lone backslash can only match at the end of a chunk
+_JSON_TOKEN_RE = re.compile(r'\\.|[{}"\\]', re.DOTALL)
+# Above this many pages, extraction goes through the Batch API instead of interactive calls
+BATCH_EXTRACTION_THRESHOLD = 50
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# Prompt templates live at module level: the static heads are byte-identical across calls
+# (which also makes them eligible for OpenAI prompt caching) and only the short tails are formatted.
+_SCHEDULE_PROMPT_HEAD: Final[str] = """
     Eres un clasificador de contenido HTML. 
     Tu tarea es determinar si el siguiente HTML contiene una **tabla de horarios de clases de entrenamiento o ejercicios**, NO un horario de atención general.
 
@@ -81,33 +113,9 @@ def detect_schedule(client: OpenAI, html_text: str) -> bool:
     ---
 
     Ahora clasifica el siguiente HTML:
-    {html_text}
     """
-    completion = client.chat.completions.create(
-        model="gpt-5-nano",
-        messages=[{"role": "user", "content": prompt}],
-    )
-    response = completion.choices[0].message.content
-    return "si" in response.lower()
 
-
-def extract_structured_data(
-        client: openai.OpenAI,
-        page_url: str,
-        url_type: str,
-        html_content: str,
-        gym_name: str,
-        lastmod: str,
-        freq: str
-) -> dict[str, list[dict[str, Any]]]:
-    """
-    Uses an OpenAI model to parse HTML and extract a list of structured "fact documents".
-    """
-    # Using .format() requires escaping the JSON braces with {{ and }}
-    # But for the placeholder {html_content}, we use single braces.
-    # The prompt is already formatted this way.
-    # Si hay tablas, las agregamos en formato legible
-    prompt_template = """
+_EXTRACT_PROMPT_HEAD: Final[str] = """
 Eres un agente de extracción de datos de clase mundial para la industria del fitness, especializado en convertir contenido web en registros estructurados para una base de datos PostgreSQL que utiliza pgvector.
 
 **Tu Objetivo:**
@@ -160,16 +168,16 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
 ### 🧩 Esquemas Esperados
 
 * **Para `"ubicaciones"`:**  
-  `{{"content_para_busqueda": str, "direccion_completa": str, "distrito": str, "horario_atencion": str}}`
+  `{"content_para_busqueda": str, "direccion_completa": str, "distrito": str, "horario_atencion": str}`
 
 * **Para `"precios"`:**  
-  `{{"content_para_busqueda": str, "sede": str, "descripcion_plan": str, "valor": float, "moneda": str, "recurrencia": str}}`
+  `{"content_para_busqueda": str, "sede": str, "descripcion_plan": str, "valor": float, "moneda": str, "recurrencia": str}`
 
 * **Para `"horarios"`:**  
-  `{{"content_para_busqueda": str, "sede": str, "nombre_clase": str, "instructor": str, "fecha": str, "dia_semana": str, "hora_inicio": str, "hora_fin": str}}`
+  `{"content_para_busqueda": str, "sede": str, "nombre_clase": str, "instructor": str, "fecha": str, "dia_semana": str, "hora_inicio": str, "hora_fin": str}`
 
 * **Para `"disciplinas"`:**  
-  `{{"content_para_busqueda": str, "nombre": str, "descripcion": str}}`
+  `{"content_para_busqueda": str, "nombre": str, "descripcion": str}`
 
 ---
 
@@ -191,27 +199,27 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
 
 **Tu Salida:**
 ```json
-{{
+{
   "ubicaciones": [
-    {{
+    {
       "content_para_busqueda": "La sede de Miraflores se encuentra en Av. Larco 123, Miraflores, Lima. Atiende de lunes a viernes de 6am a 10pm y sábados de 8am a 6pm.",
       "direccion_completa": "Av. Larco 123, Miraflores, Lima",
       "distrito": "Miraflores",
       "horario_atencion": "Lunes a Viernes 6am - 10pm; Sábados 8am - 6pm"
-    }}
+    }
   ],
   "precios": [
-    {{
+    {
       "content_para_busqueda": "Plan Anual Exclusivo disponible por S/ 1500 en la sede Miraflores.",
       "sede": "Miraflores",
       "descripcion_plan": "Plan Anual Exclusivo",
       "valor": 1500.0,
       "moneda": "PEN",
       "recurrencia": "anual"
-    }}
+    }
   ],
   "horarios": [
-    {{
+    {
       "content_para_busqueda": "Clase de Yoga Flow el martes a las 9am con Mariana en la sede Miraflores.",
       "sede": "Miraflores",
       "nombre_clase": "Yoga Flow",
@@ -220,8 +228,8 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
       "dia_semana": "Martes",
       "hora_inicio": "09:00",
       "hora_fin": "",
-    }},
-    {{
+    },
+    {
       "content_para_busqueda": "Clase de Entrenamiento Funcional el jueves a las 7pm con José en la sede Miraflores.",
       "sede": "Miraflores",
       "nombre_clase": "Entrenamiento Funcional",
@@ -230,10 +238,10 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
       "dia_semana": "Jueves",
       "hora_inicio": "19:00",
       "hora_fin": ""
-    }}
+    }
   ],
   "disciplinas": []
-}}
+}
 ```
 
 ---
@@ -250,12 +258,12 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
 
 **Tu Salida:**
 ```json
-{{
+{
   "ubicaciones": [],
   "precios": [],
   "horarios": [],
   "disciplinas": []
-}}
+}
 ```
 
 ---
@@ -274,62 +282,307 @@ Distingue **horarios de atención del establecimiento** (por ejemplo, "Lunes a V
 
 **Tu Salida:**
 ```json
-{{
+{
   "ubicaciones": [],
   "precios": [],
   "horarios": [],
   "disciplinas": [
-    {{
+    {
       "content_para_busqueda": "Yoga: mejora la flexibilidad y la conexión mente-cuerpo.",
       "nombre": "Yoga",
       "descripcion": "Mejora la flexibilidad y la conexión mente-cuerpo."
-    }},
-    {{
+    },
+    {
       "content_para_busqueda": "Pilates: fortalece el core y mejora la postura.",
       "nombre": "Pilates",
       "descripcion": "Fortalece el core y mejora la postura."
-    }},
-    {{
+    },
+    {
       "content_para_busqueda": "Spinning: disciplina cardiovascular en bicicleta estática.",
       "nombre": "Spinning",
       "descripcion": "Entrenamiento cardiovascular en bicicleta estática."
-    }},
-    {{
+    },
+    {
       "content_para_busqueda": "Entrenamiento Funcional: mejora la fuerza general con movimientos naturales.",
       "nombre": "Entrenamiento Funcional",
       "descripcion": "Mejora la fuerza general con movimientos naturales."
-    }}
+    }
   ]
-}}
+}
 ```
 
 ### Ejemplo 4: Texto con horario complejo (tabla organizada semanalmente)
 
 ---
 
+"""
+
+# Everything above is byte-identical across calls, so OpenAI's automatic prompt caching can reuse it.
+# Below the "## Task" marker, values shared by a whole run (gym, date) come before the per-page ones,
+# with the HTML last, to keep the cacheable prefix as long as possible.
+_EXTRACT_PROMPT_TAIL_TEMPLATE: Final[str] = """## Task
 **Tarea Final:**  
 Analiza las siguientes entradas y genera el objeto JSON estructurado.
 
 **gym_name:** "{gym_name}"  
+**date**
+{date}
 **page_url:** "{page_url}"  
 **url_type:** "{url_type}"  
+**lastmod**
+{last_mod}
+**changefreq**
+{changefreq}
 **html_content:**  
 '''  
 {html_content}
 '''
+
+**Tu Salida:**  
+```json
+...
+```
+"""
+
+_CATEGORIZATION_PROMPT_HEAD: Final[str] = """
+You are an expert data architect and SEO analyst specializing in the fitness industry. Your task is to analyze a list of URLs from a gym's website sitemap and categorize them based on their likely content.
+
+You will be given a numbered list of URLs, one per line as `<index>: <url>`. Your goal is to determine which URLs are most likely to contain information about:
+1.  **locations**: Physical gym locations, addresses, maps, contact pages.
+2.  **pricing**: Membership plans, prices, fees, sign-up offers.
+3.  **schedules**: Class timetables, calendars, schedules for different locations.
+4.  **disciplines**: Information about specific types of activities like Yoga, Pilates, Cycling, etc.
+
+You MUST return a JSON object with four keys: "locations", "pricing", "schedules", and "disciplines". Each key should contain a list of the integer **indices** of the URLs that belong to that category (do NOT repeat the URLs). A URL can appear in multiple categories if it's relevant to more than one.
+
+Analyze the URL path carefully. Prioritize Spanish keywords such as 'sedes', 'precios', 'horarios', but also consider English and Portuguese equivalents.
+
+---
+**Example 1: Standard URLs**
+**Input URLs:**
+0: https://example.com/es/nuestros-gimnasios
+1: https://example.com/es/tarifas-2024
+2: https://example.com/blog/post-1
+
+**Your Output:**
+{
+  "locations": [0],
+  "pricing": [1],
+  "schedules": [],
+  "disciplines": []
+}
+---
+**Example 2: Complex and Overlapping URLs**
+**Input URLs:**
+0: https://example.com/clases-y-horarios
+1: https://example.com/sedes/miraflores
+2: https://example.com/disciplinas/yoga-y-pilates
+3: https://example.com/es/contacto
+
+**Your Output:**
+{
+  "locations": [1, 3],
+  "pricing": [],
+  "schedules": [0],
+  "disciplines": [0, 2]
+}
+---
+**End of Examples. Now, complete the real task.**
+
+"""
+
+_CATEGORIZATION_PROMPT_TAIL_TEMPLATE: Final[str] = """**Task: Categorize the following URLs.**
+
+**Input URLs:**
+{urls_list}
+
+**Your Output:**
+"""
+
+
+def create_client() -> openai.OpenAI:
+    """
+    Creates the OpenAI client shared by every call site, so its connection pool is reused.
+    The SDK retries connection errors, 408/409/429 and 5xx responses with exponential backoff.
+    """
+    return openai.OpenAI(max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
+
+
+def create_async_client(max_connections: int = MAX_CONCURRENT_REQUESTS) -> openai.AsyncOpenAI:
+    """
+    Creates an AsyncOpenAI client backed by a single pooled httpx.AsyncClient,
+    so TCP/TLS connections are reused across all concurrent calls.
+    """
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    )
+    return openai.AsyncOpenAI(http_client=http_client, max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
+
+
+def _build_ubicacion_content(fact: dict) -> str:
+    g = fact.get
+    summary = f"La sede se encuentra en {g('direccion_completa', 'dirección no especificada')}"
+    distrito = g('distrito')
+    if distrito:
+        summary += f" en el distrito de {distrito}."
+    return summary
+
+
+def _build_precio_content(fact: dict) -> str:
+    g = fact.get
+    summary = f"Se ofrece un plan '{g('descripcion_plan', 'no especificado')}'"
+    valor = g('valor')
+    if valor is not None:
+        summary += f" por {valor} {g('moneda', '')}."
+    return summary
+
+
+def _build_horario_content(fact: dict) -> str:
+    g = fact.get
+    summary = (f"La clase '{g('nombre_clase', 'no especificada')}' es impartida por "
+               f"{g('instructor', 'instructor no especificado')}")
+    dia_semana = g('dia_semana')
+    if dia_semana:
+        summary += f" el día {dia_semana} de {g('hora_inicio', '')} a {g('hora_fin', '')}."
+    fecha = g('fecha')
+    if fecha:
+        summary += f" en la fecha {fecha}."
+    return summary
+
+
+_BUILDERS: dict[str, Callable[[dict], str]] = {
+    "ubicaciones": _build_ubicacion_content,
+    "precios": _build_precio_content,
+    "horarios": _build_horario_content,
+}
+
+
+def _sanitize_and_generate_content(facts: list[dict], category: str) -> list[dict]:
+    """
+    Una función interna para sanitizar los hechos y generar el campo de contenido si falta.
+    Esta es nuestra red de seguridad contra las inconsistencias del LLM.
+    """
+    # La categoría no cambia dentro del bucle: elegimos el generador una sola vez
+    build = _BUILDERS.get(category)
+    if build is None:  # Fallback genérico
+        def build(fact: dict) -> str:
+            return f"Dato de tipo '{category}': " + ", ".join(
+                f"{k}: {v}" for k, v in fact.items() if k != 'content_para_busqueda' and v)
+
+    sanitized_facts = []
+    append = sanitized_facts.append
+    for fact in facts:
+        if not isinstance(fact, dict):
+            continue  # Ignorar elementos que no son diccionarios
+
+        # Si 'content_para_busqueda' falta o está vacío, lo generamos
+        if not str(fact.get("content_para_busqueda") or "").strip():
+            log.info("🛠️ Generando 'content_para_busqueda' faltante para un hecho de '%s'.", category)
+            fact["content_para_busqueda"] = build(fact).strip()
+
+        append(fact)
+    return sanitized_facts
+
+
+def prune_html(html_content: str, max_tokens: int = MAX_HTML_TOKENS) -> str:
+    """
+    Last line of defense before the prompt: drops noise blocks (scripts, styles, navigation...),
+    comments and inline data URIs, collapses whitespace and truncates to the token budget.
+    """
+    html_content = _NOISE_BLOCK_RE.sub(" ", html_content)
+    html_content = _COMMENT_RE.sub(" ", html_content)
+    html_content = _DATA_URI_RE.sub("", html_content)
+    html_content = _WHITESPACE_RE.sub(" ", html_content).strip()
+    max_chars = int(max_tokens * CHARS_PER_TOKEN)
+    if len(html_content) > max_chars:
+        log.warning("⚠️ HTML exceeds ~%s tokens (%s chars), truncating", max_tokens, len(html_content))
+        html_content = html_content[:max_chars]
+    return html_content
+
+
+def _build_schedule_prompt(html_text: str) -> str:
+    return _SCHEDULE_PROMPT_HEAD + html_text + "\n    "
+
+
+def detect_schedule(client: OpenAI, html_text: str) -> bool:
+    """
+    Asks the small model whether the HTML holds schedule info. A failed call counts as "no schedule",
+    so the page is still extracted (with the smaller model) instead of being lost.
+    """
+    try:
+        completion = client.chat.completions.create(
+            model="gpt-5-nano",
+            messages=[{"role": "user", "content": _build_schedule_prompt(html_text)}],
+        )
+    except RECOVERABLE_ERRORS as e:
+        log.warning("⚠️ Schedule detection failed, assuming no schedule: %s", e)
+        return False
+    response = completion.choices[0].message.content or ""
+    return "si" in response.lower()
+
+
+async def detect_schedule_async(
+        client: openai.AsyncOpenAI,
+        html_text: str,
+        semaphore: asyncio.Semaphore | None = None
+) -> bool:
+    """Async version of `detect_schedule`."""
+    try:
+        async with semaphore or contextlib.nullcontext():
+            completion = await client.chat.completions.create(
+                model="gpt-5-nano",
+                messages=[{"role": "user", "content": _build_schedule_prompt(html_text)}],
+            )
+    except RECOVERABLE_ERRORS as e:
+        log.warning("⚠️ Schedule detection failed, assuming no schedule: %s", e)
+        return False
+    response = completion.choices[0].message.content or ""
+    return "si" in response.lower()
+
+
+# Multi-fragment variant of the tail above: the per-page fields are shared and each fragment
+# gets its own labeled section
+_EXTRACT_BATCH_PROMPT_TAIL_TEMPLATE: Final[str] = """## Task
+**Tarea Final:**  
+Las entradas son varios fragmentos (iframes) de una misma página. Analiza cada fragmento por separado y genera
+un objeto JSON con la clave "frames": una entrada por fragmento, con su `index` (el número N de su sección
+"Fragmento N") y las claves "ubicaciones", "precios", "horarios" y "disciplinas" descritas arriba.
+
+**gym_name:** "{gym_name}"  
+**date**
+{date}
+**url_type:** "{url_type}"  
 **lastmod**
 {last_mod}
 **changefreq**
 {changefreq}
-**date**
-{date}
 
+{sections}
 **Tu Salida:**  
 ```json
-...
+{{"frames": [...]}}
 ```
 """
-    full_prompt = prompt_template.format(
+
+_EXTRACT_BATCH_SECTION_TEMPLATE: Final[str] = """### Fragmento {index}
+**frame_url:** "{frame_url}"  
+**html_content:**  
+'''  
+{html_content}
+'''
+
+"""
+
+
+def _build_extraction_prompt(
+        page_url: str,
+        url_type: str,
+        html_content: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str
+) -> str:
+    return _EXTRACT_PROMPT_HEAD + _EXTRACT_PROMPT_TAIL_TEMPLATE.format(
         gym_name=gym_name,
         page_url=page_url,
         url_type=url_type,
@@ -338,181 +591,976 @@ Analiza las siguientes entradas y genera el objeto JSON estructurado.
         changefreq=freq,
         date=datetime.date.today().strftime("%A, %d-%m-%Y").capitalize()
     )
+
+
+def _build_batch_extraction_prompt(
+        fragments: list[tuple[str, str]],
+        url_type: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str
+) -> str:
+    sections = "".join(
+        _EXTRACT_BATCH_SECTION_TEMPLATE.format(index=i, frame_url=frame_url, html_content=html_content)
+        for i, (frame_url, html_content) in enumerate(fragments, start=1)
+    )
+    return _EXTRACT_PROMPT_HEAD + _EXTRACT_BATCH_PROMPT_TAIL_TEMPLATE.format(
+        gym_name=gym_name,
+        url_type=url_type,
+        last_mod=lastmod,
+        changefreq=freq,
+        date=datetime.date.today().strftime("%A, %d-%m-%Y").capitalize(),
+        sections=sections
+    )
+
+
+def _extraction_model(has_schedule_info: bool) -> str:
+    return "gpt-5-mini-2025-08-07" if has_schedule_info else "gpt-5-nano"
+
+
+def _extraction_request(full_prompt: str, has_schedule_info: bool) -> dict[str, Any]:
+    """
+    Keyword arguments for `chat.completions.create`, shared by the interactive and batch paths.
+    """
+    return {
+        "model": _extraction_model(has_schedule_info),
+        "messages": [{"role": "user", "content": full_prompt}],
+        # Structured outputs: the API enforces the GymFacts schema server-side
+        "response_format": GYM_FACTS_RESPONSE_FORMAT,
+        # Routes every extraction to the same cache shard for the shared prompt prefix
+        "prompt_cache_key": f"gym-extraction-{EXTRACTION_PROMPT_VERSION}",
+    }
+
+
+class _JsonObjectAccumulator:
+    """
+    Collects streamed completion text and tracks the brace depth of the top-level JSON object
+    (ignoring braces inside strings), so reading can stop as soon as the object is closed.
+    """
+
+    def __init__(self):
+        self.parts: list[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.pending_escape = False
+
+    def feed(self, text: str) -> bool:
+        """Appends a chunk of text; returns True once the top-level object has been closed."""
+        start = 0
+        if self.pending_escape:
+            # The previous chunk ended with a backslash, so the first character here is escaped
+            self.pending_escape = False
+            start = 1
+        for match in _JSON_TOKEN_RE.finditer(text, start):
+            token = match.group()
+            if self.in_string:
+                if token == '"':
+                    self.in_string = False
+                elif token == "\\":
+                    self.pending_escape = True
+            elif token == '"':
+                self.in_string = True
+            elif token == "{":
+                self.depth += 1
+            elif token == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[:match.end()])
+                    return True
+        self.parts.append(text)
+        return False
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def _read_streamed_json(stream: openai.Stream) -> str:
+    accumulator = _JsonObjectAccumulator()
+    with stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content and accumulator.feed(chunk.choices[0].delta.content):
+                break
+    return accumulator.text()
+
+
+async def _read_streamed_json_async(stream: openai.AsyncStream) -> str:
+    # Each `async for` step awaits the network, so other pages make progress while this one streams
+    accumulator = _JsonObjectAccumulator()
+    async with stream:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content and accumulator.feed(chunk.choices[0].delta.content):
+                break
+    return accumulator.text()
+
+
+def _validation_feedback(response_content: str | None, error: ValidationError) -> list[dict[str, str]]:
+    """
+    Messages to append to a conversation whose last answer failed validation, so the model
+    sees its own output and the error on the next attempt.
+    """
+    return [
+        {"role": "assistant", "content": response_content or ""},
+        {"role": "user", "content": f"Your output had error: {error}. Fix and retry."},
+    ]
+
+
+def _validate_extraction(response_content: str | None) -> dict[str, list[dict[str, Any]]]:
+    """Validates the model's JSON output against `GymFacts`; raises ValidationError on mismatch."""
+    return GymFacts.model_validate_json(response_content or "").model_dump()
+
+
+def _validate_or_sanitize(response_content: str | None) -> dict[str, list[dict[str, Any]]]:
+    """
+    Validates the model's JSON output; if that fails, runs it through the sanitizer (which fills
+    blank `content_para_busqueda` fields for free) and validates again. Raises ValidationError
+    only for errors the sanitizer cannot fix.
+    """
+    try:
+        return _validate_extraction(response_content)
+    except ValidationError as e:
+        error = e
+    try:
+        sanitized = _sanitize_extraction(response_content)
+    except json.JSONDecodeError:
+        raise error from None
+    return GymFacts.model_validate(sanitized).model_dump()
+
+
+def _parse_extraction_response(response_content: str | None) -> dict[str, list[dict[str, Any]]]:
+    """
+    Validates the model's JSON output against `GymFacts`. Only if that fails (e.g. a blank
+    `content_para_busqueda`) is every category run through the sanitizer.
+    """
+    try:
+        return _validate_extraction(response_content)
+    except ValidationError as e:
+        log.info("🛠️ Output does not match the schema (%s errors), sanitizing...", e.error_count())
+    return _sanitize_extraction(response_content)
+
+
+def _sanitize_extraction(response_content: str | None) -> dict[str, list[dict[str, Any]]]:
+    if not response_content:
+        return {}
+
+    # The entire response is a JSON object, but the actual data is inside a list.
+    # Sometimes the model might wrap the list in a key, e.g., {"data": [...]}.
+    # We need to robustly extract the list.
+    return _sanitize_facts(_loads(response_content))
+
+
+def _sanitize_facts(parsed_json: dict[str, Any]) -> dict[str, list[dict[str, Any]]]:
+    sanitized_output = {}
+    for category in EXTRACTION_CATEGORIES:
+        if category in parsed_json and isinstance(parsed_json[category], list):
+            # Pasa la lista de hechos a través de nuestra red de seguridad
+            sanitized_facts = _sanitize_and_generate_content(parsed_json[category], category)
+            sanitized_output[category] = sanitized_facts
+        else:
+            # Asegurarse de que la clave siempre exista, incluso si está vacía
+            sanitized_output[category] = []
+
+    log.info("✅ Sanitization complete.")
+    return sanitized_output
+
+
+def _validate_or_sanitize_facts(facts: dict[str, Any]) -> dict[str, list[dict[str, Any]]]:
+    """
+    Same as `_validate_or_sanitize` for output that is already parsed, e.g. one frame of a
+    multi-fragment reply. Keys other than the extraction categories are ignored.
+    """
+    facts = {category: facts.get(category) for category in EXTRACTION_CATEGORIES}
+    try:
+        return GymFacts.model_validate(facts).model_dump()
+    except ValidationError:
+        return GymFacts.model_validate(_sanitize_facts(facts)).model_dump()
+
+
+def _get_cached_extraction(cache: ExtractionCache | None, key: str) -> dict[str, list[dict[str, Any]]] | None:
+    """
+    Returns a cached extraction if it still has the expected shape; malformed entries are evicted.
+    """
+    if cache is None:
+        return None
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    if isinstance(cached, dict) and all(isinstance(cached.get(c), list) for c in EXTRACTION_CATEGORIES):
+        return cached
+    log.warning("⚠️ Evicting invalid cache entry %s", key)
+    cache.evict(key)
+    return None
+
+
+def _put_cached_extraction(
+        cache: ExtractionCache | None,
+        key: str,
+        value: dict[str, list[dict[str, Any]]],
+        model: str
+) -> None:
+    if cache is not None and value:
+        cache.put(key, value, {"model": model, "prompt_version": EXTRACTION_PROMPT_VERSION})
+
+
+def extract_structured_data(
+        client: openai.OpenAI,
+        page_url: str,
+        url_type: str,
+        html_content: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str,
+        cache: ExtractionCache | None = None
+) -> dict[str, list[dict[str, Any]]]:
+    """
+    Uses an OpenAI model to parse HTML and extract a list of structured "fact documents".
+    If `cache` is given, byte-identical pages are served from disk without calling the model.
+    """
+    cache_key = make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, page_url, html_content)
+    cached = _get_cached_extraction(cache, cache_key)
+    if cached is not None:
+        log.info("💾 Cache hit for %s", page_url)
+        return cached
+
+    html_content = prune_html(html_content)
+    full_prompt = _build_extraction_prompt(page_url, url_type, html_content, gym_name, lastmod, freq)
     has_schedule_info = detect_schedule(client, html_content)
     if has_schedule_info:
-        logging.info("Detected schedule info, calling larger model for extraction ...")
+        log.info("Detected schedule info, calling larger model for extraction ...")
     try:
-        logging.info(f"Calling OpenAI to extract data from {page_url}...")
-        completion = client.chat.completions.create(
-            model="gpt-5-mini-2025-08-07" if has_schedule_info else "gpt-5-nano",
-            messages=[{"role": "user", "content": full_prompt}],
-            # IMPORTANT: Use JSON mode to guarantee valid JSON output
-            response_format={"type": "json_object"}
-        )
-        response_content = completion.choices[0].message.content
+        log.info("Calling OpenAI to extract data from %s...", page_url)
+        request = _extraction_request(full_prompt, has_schedule_info)
+        for attempt in range(VALIDATION_MAX_RETRIES + 1):
+            stream = client.chat.completions.create(**request, stream=True)
+            response_content = _read_streamed_json(stream)
+            try:
+                result = _validate_or_sanitize(response_content)
+                break
+            except ValidationError as ve:
+                if attempt == VALIDATION_MAX_RETRIES:
+                    log.info("🛠️ Output still invalid after %s attempts, sanitizing...", attempt + 1)
+                    result = _sanitize_extraction(response_content)
+                    break
+                log.warning("⚠️ Invalid output for %s (%s errors), retrying...", page_url, ve.error_count())
+                request["messages"].extend(_validation_feedback(response_content, ve))
+                time.sleep(1.0 * (attempt + 1))
+        _put_cached_extraction(cache, cache_key, result, request["model"])
+        return result
+
+    except RECOVERABLE_ERRORS as e:
+        log.error("     ❌ An error occurred calling OpenAI: %s", e)
+        return {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
 
-        # The entire response is a JSON object, but the actual data is inside a list.
-        # Sometimes the model might wrap the list in a key, e.g., {"data": [...]}.
-        # We need to robustly extract the list.
-        if not response_content:
-            return {}
 
-        parsed_json = json.loads(response_content)
+async def extract_structured_data_async(
+        client: openai.AsyncOpenAI,
+        page_url: str,
+        url_type: str,
+        html_content: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str,
+        semaphore: asyncio.Semaphore | None = None,
+        cache: ExtractionCache | None = None
+) -> dict[str, list[dict[str, Any]]]:
+    """
+    Async version of `extract_structured_data`. Every OpenAI call is made while holding
+    `semaphore`, so many pages can be processed concurrently without exceeding rate limits.
+    """
+    cache_key = make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, page_url, html_content)
+    cached = _get_cached_extraction(cache, cache_key)
+    if cached is not None:
+        log.info("💾 Cache hit for %s", page_url)
+        return cached
+
+    html_content = prune_html(html_content)
+    full_prompt = _build_extraction_prompt(page_url, url_type, html_content, gym_name, lastmod, freq)
+    has_schedule_info = await detect_schedule_async(client, html_content, semaphore)
+    if has_schedule_info:
+        log.info("Detected schedule info, calling larger model for extraction ...")
+    try:
+        log.info("Calling OpenAI to extract data from %s...", page_url)
+        request = _extraction_request(full_prompt, has_schedule_info)
+        for attempt in range(VALIDATION_MAX_RETRIES + 1):
+            async with semaphore or contextlib.nullcontext():
+                stream = await client.chat.completions.create(**request, stream=True)
+                response_content = await _read_streamed_json_async(stream)
+            try:
+                result = _validate_or_sanitize(response_content)
+                break
+            except ValidationError as ve:
+                if attempt == VALIDATION_MAX_RETRIES:
+                    log.info("🛠️ Output still invalid after %s attempts, sanitizing...", attempt + 1)
+                    result = _sanitize_extraction(response_content)
+                    break
+                log.warning("⚠️ Invalid output for %s (%s errors), retrying...", page_url, ve.error_count())
+                request["messages"].extend(_validation_feedback(response_content, ve))
+                await asyncio.sleep(1.0 * (attempt + 1))
+        _put_cached_extraction(cache, cache_key, result, request["model"])
+        return result
+
+    except RECOVERABLE_ERRORS as e:
+        log.error("     ❌ An error occurred calling OpenAI: %s", e)
+        return {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
 
-        sanitized_output = {}
-        for category in ["ubicaciones", "precios", "horarios", "disciplinas"]:
-            if category in parsed_json and isinstance(parsed_json[category], list):
-                # Pasa la lista de hechos a través de nuestra red de seguridad
-                sanitized_facts = _sanitize_and_generate_content(parsed_json[category], category)
-                sanitized_output[category] = sanitized_facts
-            else:
-                # Asegurarse de que la clave siempre exista, incluso si está vacía
-                sanitized_output[category] = []
 
-        logging.info("✅ Sanitization complete.")
-        return sanitized_output
-        # --- FIN DE LA NUEVA LÓGICA ---
+async def extract_many(
+        client: openai.AsyncOpenAI,
+        pages: list[dict[str, str]],
+        max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+        cache: ExtractionCache | None = None
+) -> list[dict[str, list[dict[str, Any]]] | BaseException]:
+    """
+    Extracts structured data from many pages concurrently.
 
-    except Exception as e:
-        logging.error(f"     ❌ An error occurred calling OpenAI: {e}")
-        return {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
+    Args:
+        client: An initialized AsyncOpenAI client instance (see `create_async_client`).
+        pages: A list of dicts with the keyword arguments of `extract_structured_data_async`
+            (page_url, url_type, html_content, gym_name, lastmod, freq).
+        max_concurrency: Maximum number of in-flight OpenAI requests.
+        cache: Optional on-disk cache shared by all pages.
+
+    Returns:
+        One result per page, in the same order. Failed pages yield their exception instead.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    tasks = [extract_structured_data_async(client, **page, semaphore=sem, cache=cache) for page in pages]
+    return await asyncio.gather(*tasks, return_exceptions=True)
 
 
-def categorize_urls_with_llm(urls: list[dict[str, str]], client: openai.OpenAI) -> dict[str, list[dict[str, str]]]:
+def _pack_fragments(fragments: list[tuple[str, str, str]]) -> list[list[tuple[str, str, str]]]:
     """
-    Uses an OpenAI LLM to categorize URLs based on their likely content.
+    Groups (url, raw_html, pruned_html) fragments greedily so the pruned HTML of each group fits
+    in the same budget as a single-page prompt.
+    """
+    max_chars = int(MAX_HTML_TOKENS * CHARS_PER_TOKEN)
+    groups, current, current_chars = [], [], 0
+    for fragment in fragments:
+        if current and current_chars + len(fragment[2]) > max_chars:
+            groups.append(current)
+            current, current_chars = [], 0
+        current.append(fragment)
+        current_chars += len(fragment[2])
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _extract_fragment_group(
+        client: openai.OpenAI,
+        group: list[tuple[str, str, str]],
+        url_type: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str
+) -> tuple[dict[str, dict[str, list[dict[str, Any]]]], str]:
+    """
+    Sends several fragments in one request. Returns the facts of every frame that validated (after
+    the sanitizer, as in `extract_structured_data`), keyed by fragment URL, and the model used.
+    Frames are matched to fragments by their section `index`, never by the URL the model echoes.
+    Fragments missing from the result (a failed call, a frame that did not validate) are left to the caller.
+    """
+    full_prompt = _build_batch_extraction_prompt([(url, pruned) for url, _, pruned in group],
+                                                 url_type, gym_name, lastmod, freq)
+    has_schedule_info = detect_schedule(client, " ".join(pruned for _, _, pruned in group))
+    request = {**_extraction_request(full_prompt, has_schedule_info), "response_format": GYM_FACTS_BATCH_RESPONSE_FORMAT}
+    try:
+        log.info("Calling OpenAI to extract data from %s fragments in one request...", len(group))
+        stream = client.chat.completions.create(**request, stream=True)
+        parsed = _loads(_read_streamed_json(stream) or "{}")
+    except RECOVERABLE_ERRORS as e:
+        log.warning("⚠️ Multi-fragment extraction failed, falling back to one call per fragment: %s", e)
+        return {}, request["model"]
+
+    frames = parsed.get("frames") if isinstance(parsed, dict) else None
+    extracted = {}
+    for frame in frames if isinstance(frames, list) else []:
+        index = frame.get("index") if isinstance(frame, dict) else None
+        if not isinstance(index, int) or not 1 <= index <= len(group) or group[index - 1][0] in extracted:
+            log.warning("⚠️ Ignoring frame with an unknown or repeated index: %r", index)
+            continue
+        try:
+            extracted[group[index - 1][0]] = _validate_or_sanitize_facts(frame)
+        except ValidationError as e:
+            log.warning("⚠️ Fragment %s is invalid (%s errors), extracting it on its own", index, e.error_count())
+    return extracted, request["model"]
+
+
+def extract_structured_data_batch(
+        client: openai.OpenAI,
+        items: list[tuple[str, str]],
+        url_type: str,
+        gym_name: str,
+        lastmod: str,
+        freq: str,
+        cache: ExtractionCache | None = None
+) -> dict[str, dict[str, list[dict[str, Any]]]]:
+    """
+    Extracts the facts of several fragments of one page (e.g. its iframes) with as few calls as
+    possible, packing fragments into shared prompts up to the HTML token budget.
+
+    Args:
+        items: (fragment_url, html_content) pairs.
+
+    Returns:
+        The extraction of every fragment, keyed by its URL. Fragments the model left out, or whose
+        group did not validate, fall back to one `extract_structured_data` call each.
+    """
+    results = {}
+    pending = []
+    for frame_url, html_content in items:
+        cached = _get_cached_extraction(
+            cache, make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, frame_url, html_content))
+        if cached is not None:
+            log.info("💾 Cache hit for %s", frame_url)
+            results[frame_url] = cached
+        else:
+            pending.append((frame_url, html_content, prune_html(html_content)))
+
+    for group in _pack_fragments(pending):
+        extracted, model = {}, ""
+        if len(group) > 1:
+            extracted, model = _extract_fragment_group(client, group, url_type, gym_name, lastmod, freq)
+        for frame_url, html_content, _ in group:
+            if frame_url in extracted:
+                results[frame_url] = extracted[frame_url]
+                cache_key = make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, frame_url, html_content)
+                _put_cached_extraction(cache, cache_key, extracted[frame_url], model)
+            else:
+                results[frame_url] = extract_structured_data(client, frame_url, url_type, html_content,
+                                                             gym_name, lastmod, freq, cache)
+    return results
+
+
+def _build_batch_input(pages: list[dict[str, str]]) -> bytes:
+    """
+    Serializes one `/v1/chat/completions` request per page into the Batch API JSONL format.
+    The schedule detector is skipped in batch mode; `url_type == "schedules"` selects the larger model instead.
+    """
+    lines = []
+    for page in pages:
+        full_prompt = _build_extraction_prompt(**{**page, "html_content": prune_html(page["html_content"])})
+        lines.append(_dumps({
+            "custom_id": page["page_url"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _extraction_request(full_prompt, page["url_type"] == "schedules"),
+        }))
+    return "\n".join(lines).encode("utf-8")
+
+
+def _split_cached_pages(
+        cache: ExtractionCache | None,
+        pages: list[dict[str, str]]
+) -> tuple[dict[str, dict[str, list[dict[str, Any]]]], list[dict[str, str]]]:
+    """Splits batch pages into cached results (keyed by page URL) and the pages still to submit."""
+    results, pending = {}, []
+    for page in pages:
+        cache_key = make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, page["page_url"], page["html_content"])
+        cached = _get_cached_extraction(cache, cache_key)
+        if cached is not None:
+            results[page["page_url"]] = cached
+        else:
+            pending.append(page)
+    if results:
+        log.info("💾 %s/%s batch pages served from cache", len(results), len(pages))
+    return results, pending
+
+
+def _cache_batch_results(
+        cache: ExtractionCache | None,
+        pages: list[dict[str, str]],
+        results: dict[str, dict[str, list[dict[str, Any]]]]
+) -> None:
+    for page in pages:
+        result = results.get(page["page_url"])
+        # Failed requests come back as empty categories; those must not be cached
+        if result and any(result.values()):
+            cache_key = make_cache_key(EXTRACTION_MODELS, EXTRACTION_PROMPT_VERSION, page["page_url"], page["html_content"])
+            _put_cached_extraction(cache, cache_key, result, _extraction_model(page["url_type"] == "schedules"))
+
+
+def _parse_batch_output(output_text: str) -> dict[str, dict[str, list[dict[str, Any]]]]:
+    """
+    Routes each line of a Batch API output file back through the extraction sanitizer, keyed by page URL.
+    """
+    results = {}
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        item = _loads(line)
+        page_url = item["custom_id"]
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            log.error("❌ Batch request failed for %s: %s", page_url, item.get('error') or response.get('body'))
+            results[page_url] = {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
+            continue
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[page_url] = _parse_extraction_response(content)
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            log.error("❌ Could not parse batch output for %s: %s", page_url, e)
+            results[page_url] = {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
+    return results
+
+
+def submit_batch_extraction(
+        client: openai.OpenAI,
+        pages: list[dict[str, str]],
+        poll_interval: float = 30.0,
+        cache: ExtractionCache | None = None
+) -> dict[str, dict[str, list[dict[str, Any]]]]:
+    """
+    Extracts structured data from many pages through the OpenAI Batch API, which halves the
+    cost of bulk runs at the expense of latency (up to the 24h completion window).
 
     Args:
-        urls: A list of URL dict (url, lastmod, changefreq, priority)  to categorize.
         client: An initialized OpenAI client instance.
+        pages: A list of dicts with the keyword arguments of `extract_structured_data`
+            (page_url, url_type, html_content, gym_name, lastmod, freq).
+        poll_interval: Seconds to wait between batch status checks.
+        cache: Optional on-disk cache; cached pages are not submitted and new results are stored.
 
     Returns:
-        A dictionary categorizing the URLs.
+        A dict mapping each page URL to its sanitized extraction output.
+    """
+    results, pages = _split_cached_pages(cache, pages)
+    if not pages:
+        return results
+    batch_file = client.files.create(file=("extraction_batch.jsonl", _build_batch_input(pages)), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    log.info("📦 Submitted extraction batch %s with %s pages", batch.id, len(pages))
+
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        log.info("⏳ Batch %s status: %s", batch.id, batch.status)
+
+    if not batch.output_file_id:
+        log.error("❌ Batch %s finished with status '%s' and no output", batch.id, batch.status)
+        return results
+    batch_results = _parse_batch_output(client.files.content(batch.output_file_id).text)
+    _cache_batch_results(cache, pages, batch_results)
+    return results | batch_results
+
+
+async def submit_batch_extraction_async(
+        client: openai.AsyncOpenAI,
+        pages: list[dict[str, str]],
+        poll_interval: float = 30.0,
+        cache: ExtractionCache | None = None
+) -> dict[str, dict[str, list[dict[str, Any]]]]:
+    """
+    Async version of `submit_batch_extraction`; polling does not block the event loop.
     """
+    results, pages = _split_cached_pages(cache, pages)
+    if not pages:
+        return results
+    batch_file = await client.files.create(file=("extraction_batch.jsonl", _build_batch_input(pages)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    log.info("📦 Submitted extraction batch %s with %s pages", batch.id, len(pages))
+
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        log.info("⏳ Batch %s status: %s", batch.id, batch.status)
+
+    if not batch.output_file_id:
+        log.error("❌ Batch %s finished with status '%s' and no output", batch.id, batch.status)
+        return results
+    output = await client.files.content(batch.output_file_id)
+    batch_results = _parse_batch_output(output.text)
+    _cache_batch_results(cache, pages, batch_results)
+    return results | batch_results
+
+
+def _build_categorization_prompt(urls: list[SitemapEntry]) -> str:
+    numbered_urls = "\n".join(f"{i}: {url.loc}" for i, url in enumerate(urls))
+    return _CATEGORIZATION_PROMPT_HEAD + _CATEGORIZATION_PROMPT_TAIL_TEMPLATE.format(urls_list=numbered_urls)
+
+
+def _map_categorized_urls(
+        categorized_urls: dict[str, list[int]],
+        urls: list[SitemapEntry]
+) -> dict[str, list[SitemapEntry]]:
+    # Rehydrate the indices returned by the model, skipping anything out of range
+    final_result = defaultdict(list)
+
+    for key, indices in categorized_urls.items():
+        for idx in indices:
+            if isinstance(idx, int) and 0 <= idx < len(urls):
+                final_result[key].append(urls[idx])
+            else:
+                log.warning("⚠️ Ignoring invalid URL index from model output: %r", idx)
 
-    # This is the prompt template from above
-    prompt_template = """
-You are an expert data architect and SEO analyst specializing in the fitness industry. Your task is to analyze a list of URLs from a gym's website sitemap and categorize them based on their likely content.
+    # Ensure all expected categories exist
+    for k in URL_CATEGORIES:
+        final_result.setdefault(k, [])
 
-You will be given a JSON list of URLs. Your goal is to determine which URLs are most likely to contain information about:
-1.  **locations**: Physical gym locations, addresses, maps, contact pages.
-2.  **pricing**: Membership plans, prices, fees, sign-up offers.
-3.  **schedules**: Class timetables, calendars, schedules for different locations.
-4.  **disciplines**: Information about specific types of activities like Yoga, Pilates, Cycling, etc.
+    return dict(final_result)
 
-You MUST return a JSON object with four keys: "locations", "pricing", "schedules", and "disciplines". Each key should contain a list of the URLs that belong to that category. A URL can appear in multiple categories if it's relevant to more than one.
 
-Analyze the URL path carefully. Prioritize Spanish keywords such as 'sedes', 'precios', 'horarios', but also consider English and Portuguese equivalents.
+def _merge_categorized_chunks(results: list[dict[str, list[SitemapEntry]]]) -> dict[str, list[SitemapEntry]]:
+    """
+    Merges per-chunk categorizations, deduplicating URLs per category while preserving order.
+    """
+    merged = defaultdict(dict)
+    for result in results:
+        for key, category_urls in result.items():
+            for u in category_urls:
+                merged[key].setdefault(u.loc, u)
+    final_result = {key: list(by_loc.values()) for key, by_loc in merged.items()}
+    for k in URL_CATEGORIES:
+        final_result.setdefault(k, [])
+    return final_result
 
----
-**Example 1: Standard URLs**
-**Input URLs:**
-["https://example.com/es/nuestros-gimnasios", "https://example.com/es/tarifas-2024", "https://example.com/blog/post-1"]
 
-**Your Output:**
-{{
-  "locations": ["https://example.com/es/nuestros-gimnasios"],
-  "pricing": ["https://example.com/es/tarifas-2024"],
-  "schedules": [],
-  "disciplines": []
-}}
----
-**Example 2: Complex and Overlapping URLs**
-**Input URLs:**
-["https://example.com/clases-y-horarios", "https://example.com/sedes/miraflores", "https://example.com/disciplinas/yoga-y-pilates", "https://example.com/es/contacto"]
+def _chunk_urls(urls: list[SitemapEntry]) -> list[list[SitemapEntry]]:
+    return [urls[i:i + CATEGORIZATION_CHUNK_SIZE] for i in range(0, len(urls), CATEGORIZATION_CHUNK_SIZE)]
 
-**Your Output:**
-{{
-  "locations": ["https://example.com/sedes/miraflores", "https://example.com/es/contacto"],
-  "pricing": [],
-  "schedules": ["https://example.com/clases-y-horarios"],
-  "disciplines": ["https://example.com/clases-y-horarios", "https://example.com/disciplinas/yoga-y-pilates"]
-}}
----
-**End of Examples. Now, complete the real task.**
 
-**Task: Categorize the following URLs.**
+def _categorization_cache_key(urls: list[SitemapEntry]) -> str:
+    return make_cache_key(CATEGORIZATION_MODEL, CATEGORIZATION_PROMPT_VERSION, "", json.dumps([u.loc for u in urls]))
 
-**Input URLs:**
-{urls_json}
 
-**Your Output:**
-"""
-    urls_list = [url["loc"] for url in urls]
-    # Format the list of URLs as a JSON string for the prompt
-    urls_as_json_string = json.dumps(urls_list)
+def _get_cached_categorization(cache: ExtractionCache | None, key: str) -> dict[str, list[int]] | None:
+    if cache is None:
+        return None
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    try:
+        return UrlCategorization.model_validate(cached).model_dump()
+    except ValidationError:
+        log.warning("⚠️ Evicting invalid cache entry %s", key)
+        cache.evict(key)
+        return None
+
 
-    # Inject the URLs into the prompt
-    full_prompt = prompt_template.format(urls_json=urls_as_json_string)
+def _parse_categorization(response_content: str | None) -> dict[str, list[int]]:
+    """Validates the model's categorization reply; raises ValidationError if it has the wrong shape."""
+    return UrlCategorization.model_validate_json(response_content or "").model_dump()
+
+
+def _categorization_request(urls: list[SitemapEntry]) -> dict[str, Any]:
+    return {
+        "model": CATEGORIZATION_MODEL,  # Use a fast, affordable model
+        "messages": [
+            {"role": "user", "content": _build_categorization_prompt(urls)}
+        ],
+        "temperature": 0.0,  # Set to 0 for deterministic, factual tasks
+        "response_format": {"type": "json_object"}  # Enable JSON mode
+    }
+
+
+def _store_categorization(cache: ExtractionCache | None, key: str, categorized_urls: dict[str, list[int]]) -> None:
+    if cache is not None:
+        cache.put(key, categorized_urls, {"model": CATEGORIZATION_MODEL, "prompt_version": CATEGORIZATION_PROMPT_VERSION})
+
+
+def _categorize_chunk(
+        urls: list[SitemapEntry],
+        client: openai.OpenAI,
+        cache: ExtractionCache | None
+) -> dict[str, list[SitemapEntry]] | None:
+    """Categorizes one chunk of URLs; returns None if the call failed, so callers can tell it from "no category"."""
+    cache_key = _categorization_cache_key(urls)
+    cached = _get_cached_categorization(cache, cache_key)
+    if cached is not None:
+        log.info("💾 Cache hit for URL categorization")
+        return _map_categorized_urls(cached, urls)
 
     try:
-        logging.info("🤖 Calling OpenAI to categorize URLs...")
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",  # Use a fast, affordable model
-            messages=[
-                {"role": "user", "content": full_prompt}
-            ],
-            temperature=0.0,  # Set to 0 for deterministic, factual tasks
-            response_format={"type": "json_object"}  # Enable JSON mode
-        )
+        log.info("🤖 Calling OpenAI to categorize %s URLs...", len(urls))
+        completion = client.chat.completions.create(**_categorization_request(urls))
 
         response_content = completion.choices[0].message.content
-        logging.info("✅ OpenAI response received.")
+        log.info("✅ OpenAI response received.")
+
+        # Only a reply with the expected shape is mapped and cached
+        categorized_urls = _parse_categorization(response_content)
+        _store_categorization(cache, cache_key, categorized_urls)
+        return _map_categorized_urls(categorized_urls, urls)
+
+    except ValidationError as e:
+        log.error("❌ Invalid categorization output (%s errors), skipping %s URLs", e.error_count(), len(urls))
+        return None
+    except RECOVERABLE_ERRORS as e:
+        log.error("❌ An error occurred while calling OpenAI: %s", e)
+        return None
+
+
+async def _categorize_chunk_async(
+        urls: list[SitemapEntry],
+        client: openai.AsyncOpenAI,
+        semaphore: asyncio.Semaphore | None,
+        cache: ExtractionCache | None
+) -> dict[str, list[SitemapEntry]] | None:
+    """Async version of `_categorize_chunk`."""
+    cache_key = _categorization_cache_key(urls)
+    cached = _get_cached_categorization(cache, cache_key)
+    if cached is not None:
+        log.info("💾 Cache hit for URL categorization")
+        return _map_categorized_urls(cached, urls)
 
-        # Parse the response safely
-        categorized_urls = json.loads(response_content)
+    try:
+        log.info("🤖 Calling OpenAI to categorize %s URLs...", len(urls))
+        async with semaphore or contextlib.nullcontext():
+            completion = await client.chat.completions.create(**_categorization_request(urls))
 
-        # Create final mapping with metadata included
-        url_lookup = {u["loc"]: u for u in urls}
-        final_result = defaultdict(list)
+        response_content = completion.choices[0].message.content
+        log.info("✅ OpenAI response received.")
 
-        for key, values in categorized_urls.items():
-            for url in values:
-                if url in url_lookup:
-                    final_result[key].append(url_lookup[url])
-                else:
-                    # If URL not found (e.g., model output error), still include it
-                    final_result[key].append({"loc": url, "lastmod": None, "changefreq": None, "priority": None})
+        # Only a reply with the expected shape is mapped and cached
+        categorized_urls = _parse_categorization(response_content)
+        _store_categorization(cache, cache_key, categorized_urls)
+        return _map_categorized_urls(categorized_urls, urls)
 
-        # Ensure all expected categories exist
-        for k in ["locations", "pricing", "schedules", "disciplines"]:
-            final_result.setdefault(k, [])
+    except ValidationError as e:
+        log.error("❌ Invalid categorization output (%s errors), skipping %s URLs", e.error_count(), len(urls))
+        return None
+    except RECOVERABLE_ERRORS as e:
+        log.error("❌ An error occurred while calling OpenAI: %s", e)
+        return None
 
-        return dict(final_result)
 
-    except Exception as e:
-        logging.error(f"❌ An error occurred while calling OpenAI: {e}")
-        return {"locations": [], "pricing": [], "schedules": [], "disciplines": []}
+def categorize_urls_with_llm(
+        urls: list[SitemapEntry],
+        client: openai.OpenAI,
+        cache: ExtractionCache | None = None
+) -> dict[str, list[SitemapEntry]]:
+    """
+    Uses an OpenAI LLM to categorize URLs based on their likely content.
+    Large sitemaps are split into chunks of `CATEGORIZATION_CHUNK_SIZE` URLs, so a failed call only loses one chunk.
 
+    Args:
+        urls: The sitemap entries to categorize.
+        client: An initialized OpenAI client instance.
+        cache: Optional on-disk cache; an identical URL chunk is served without calling the model.
 
-def merge_gym_data_with_llm(gym_name: str, url_to_json_map: dict[str, dict | str], client: openai.OpenAI) -> dict:
+    Returns:
+        A dictionary categorizing the URLs.
+    """
+    results = [_categorize_chunk(chunk, client, cache) for chunk in _chunk_urls(urls)]
+    return _merge_categorized_chunks([result for result in results if result is not None])
+
+
+async def _categorize_chunks_async(
+        chunks: list[list[SitemapEntry]],
+        client: openai.AsyncOpenAI,
+        semaphore: asyncio.Semaphore | None,
+        cache: ExtractionCache | None
+) -> list[dict[str, list[SitemapEntry]] | None]:
+    """Categorizes every chunk concurrently; results keep the chunk order and failed chunks yield None."""
+    return list(await asyncio.gather(*[
+        _categorize_chunk_async(chunk, client, semaphore, cache) for chunk in chunks
+    ]))
+
+
+async def categorize_urls_with_llm_async(
+        urls: list[SitemapEntry],
+        client: openai.AsyncOpenAI,
+        semaphore: asyncio.Semaphore | None = None,
+        cache: ExtractionCache | None = None
+) -> dict[str, list[SitemapEntry]]:
+    """
+    Async version of `categorize_urls_with_llm`: all chunks are categorized concurrently.
+    """
+    results = await _categorize_chunks_async(_chunk_urls(urls), client, semaphore, cache)
+    return _merge_categorized_chunks([result for result in results if result is not None])
+
+
+def _normalize_url_path(url: str) -> str:
+    return urlparse(url).path.lower() or "/"
+
+
+async def _embed_paths(client: openai.AsyncOpenAI, paths: list[str]) -> dict[str, list[float]]:
+    """Embeds every path, `EMBEDDING_BATCH_SIZE` inputs per request."""
+    embeddings = {}
+    for i in range(0, len(paths), EMBEDDING_BATCH_SIZE):
+        batch = paths[i:i + EMBEDDING_BATCH_SIZE]
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+        embeddings.update((p, d.embedding) for p, d in zip(batch, response.data))
+    return embeddings
+
+
+async def categorize_urls_with_semantic_cache_async(
+        urls: list[SitemapEntry],
+        client: openai.AsyncOpenAI,
+        index: UrlCategoryIndex,
+        semaphore: asyncio.Semaphore | None = None,
+        cache: ExtractionCache | None = None
+) -> dict[str, list[SitemapEntry]]:
+    """
+    Categorizes URLs reusing the labels of semantically similar, previously categorized paths.
+    Only paths without a close enough neighbour in `index` are sent to the LLM;
+    the labels of the chunks that succeeded are then added to the index for future runs.
+
+    Args:
+        urls: The sitemap entries to categorize.
+        client: An initialized AsyncOpenAI client instance.
+        index: The semantic path -> categories index.
+        semaphore: Optional bound on the in-flight categorization calls.
+        cache: Optional on-disk cache for the categorization calls.
+
+    Returns:
+        A dictionary categorizing the URLs.
+    """
+    if not urls:
+        return {k: [] for k in URL_CATEGORIES}
+
+    paths = [_normalize_url_path(u.loc) for u in urls]
+    unique_paths = list(dict.fromkeys(paths))
+    try:
+        embeddings = await _embed_paths(client, unique_paths)
+    except RECOVERABLE_ERRORS as e:
+        log.error("❌ Could not embed URL paths, categorizing without the semantic cache: %s", e)
+        return await categorize_urls_with_llm_async(urls, client, semaphore, cache)
+    cached_labels = dict(zip(unique_paths, index.lookup([embeddings[p] for p in unique_paths])))
+
+    final_result = {k: [] for k in URL_CATEGORIES}
+    residual = []
+    for url, path in zip(urls, paths):
+        labels = cached_labels[path]
+        if labels is None:
+            residual.append(url)
+            continue
+        for label in labels:
+            final_result.setdefault(label, []).append(url)
+    log.info("🧠 Semantic cache categorized %s/%s URLs", len(urls) - len(residual), len(urls))
+
+    if residual:
+        chunks = _chunk_urls(residual)
+        results = await _categorize_chunks_async(chunks, client, semaphore, cache)
+        llm_result = _merge_categorized_chunks([result for result in results if result is not None])
+        residual_labels = defaultdict(list)
+        for label, category_urls in llm_result.items():
+            final_result.setdefault(label, []).extend(category_urls)
+            for url in category_urls:
+                residual_labels[_normalize_url_path(url.loc)].append(label)
+        # Paths of failed chunks stay out of the index, so the next run sends them to the LLM again
+        new_paths = list(dict.fromkeys(
+            _normalize_url_path(u.loc)
+            for chunk, result in zip(chunks, results) if result is not None
+            for u in chunk
+        ))
+        if new_paths:
+            index.add(new_paths, [embeddings[p] for p in new_paths], [residual_labels[p] for p in new_paths])
+            index.save()
+
+    return final_result
+
+
+async def categorize_urls_async(
+        urls: list[SitemapEntry],
+        client: openai.AsyncOpenAI,
+        cache: ExtractionCache | None = None,
+        index: UrlCategoryIndex | None = None,
+        strict: bool = False,
+        max_concurrency: int = MAX_CONCURRENT_REQUESTS
+) -> dict[str, list[SitemapEntry]]:
     """
-    Usa un LLM para combinar múltiples outputs JSON (uno por URL)
-    en un único JSON con las claves 'ubicaciones', 'precios', 'horarios' y 'disciplinas'.
+    Categorizes URLs with the keyword prefilter first and only forwards the ambiguous ones to the LLM
+    (through the semantic cache if `index` is given), at most `max_concurrency` chunks at a time.
+    With `strict=True` the LLM is never called and ambiguous URLs are dropped.
     """
+    categorized, ambiguous = fast_categorize_urls(urls)
+    log.info("🔎 Keyword prefilter categorized %s/%s URLs", len(urls) - len(ambiguous), len(urls))
+    if not ambiguous or strict:
+        return categorized
 
-    serialized_sections = []
+    sem = asyncio.Semaphore(max_concurrency)
+    if index is not None:
+        llm_result = await categorize_urls_with_semantic_cache_async(ambiguous, client, index, sem, cache)
+    else:
+        llm_result = await categorize_urls_with_llm_async(ambiguous, client, sem, cache)
+    return _merge_categorized_chunks([categorized, llm_result])
+
+
+def _normalize_fact_value(value: Any) -> str:
+    if value is None:
+        return ""
+    return _WHITESPACE_RE.sub(" ", str(value)).strip().casefold()
+
+
+def _normalize_price(value: Any) -> float | str:
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return _normalize_fact_value(value)
+
+
+def _fact_key(*fields: str) -> Callable[[dict], tuple]:
+    return lambda fact: tuple(_normalize_fact_value(fact.get(f)) for f in fields)
+
+
+# Claves normalizadas para detectar duplicados exactos entre páginas
+_FACT_KEYS: dict[str, Callable[[dict], tuple]] = {
+    "ubicaciones": _fact_key("direccion_completa", "distrito"),
+    "precios": lambda fact: (
+        _normalize_fact_value(fact.get("sede")),
+        _normalize_fact_value(fact.get("descripcion_plan")),
+        _normalize_price(fact.get("valor")),
+        _normalize_fact_value(fact.get("moneda")),
+    ),
+    "horarios": _fact_key("sede", "nombre_clase", "instructor", "fecha", "dia_semana", "hora_inicio", "hora_fin"),
+    "disciplinas": _fact_key("nombre"),
+}
+
+
+def merge_gym_data_locally(url_to_json_map: dict[str, dict | str]) -> dict[str, list[dict]]:
+    """
+    Combina los outputs de todas las URLs y elimina duplicados exactos (tras normalizar
+    espacios y mayúsculas), conservando el primer hecho visto para cada clave.
+    """
+    merged = {category: {} for category in EXTRACTION_CATEGORIES}
     for url, content in url_to_json_map.items():
-        if isinstance(content, dict):
-            content_str = json.dumps(content, ensure_ascii=False, indent=2)
-        else:
-            content_str = str(content)
-        serialized_sections.append(f"📄 **URL:** {url}\n```json\n{content_str}\n```")
+        if not isinstance(content, dict):
+            log.warning("⚠️ Ignoring non-JSON extraction output for %s", url)
+            continue
+        for category in EXTRACTION_CATEGORIES:
+            key_of = _FACT_KEYS[category]
+            seen = merged[category]
+            for fact in content.get(category) or []:
+                if isinstance(fact, dict):
+                    seen.setdefault(key_of(fact), fact)
+    return {category: list(facts.values()) for category, facts in merged.items()}
+
+
+def merge_gym_data_with_llm(gym_name: str, url_to_json_map: dict[str, dict | str], client: openai.OpenAI) -> dict:
+    """
+    Combina múltiples outputs JSON (uno por URL) en un único JSON con las claves
+    'ubicaciones', 'precios', 'horarios' y 'disciplinas'. Los duplicados exactos se eliminan
+    localmente; el LLM solo consolida los duplicados semánticos que quedan, y no se llama
+    si ninguna categoría tiene al menos `MERGE_LLM_MIN_FACTS` hechos. Si la salida del LLM sigue
+    sin validar tras los reintentos, se devuelven los datos deduplicados localmente.
+    """
+    deduped = merge_gym_data_locally(url_to_json_map)
+    if all(len(facts) < MERGE_LLM_MIN_FACTS for facts in deduped.values()):
+        log.info("Nothing left to consolidate, skipping LLM merge")
+        return {"gym": gym_name, **deduped}
 
-    joined_inputs = "\n\n---\n\n".join(serialized_sections)
+    joined_inputs = _dumps(deduped)
 
     prompt = f"""
 Eres un experto en integración y limpieza de datos para gimnasios y centros fitness.
 
-Tu tarea es combinar y deduplicar información estructurada extraída desde **múltiples páginas del gimnasio "{gym_name}"**.
+Tu tarea es deduplicar información estructurada extraída desde **múltiples páginas del gimnasio "{gym_name}"**.
 
-Cada página contiene datos parciales en formato JSON, con las claves:
-`"ubicaciones"`, `"precios"`, `"disciplinas"`.
+Los datos de entrada ya fueron combinados en un solo JSON y los duplicados exactos ya fueron eliminados, con las claves:
+`"ubicaciones"`, `"precios"`, `"horarios"`, `"disciplinas"`.
 
 ---
 
 ### 🧩 Tu objetivo
-Fusiona todas las entradas de distintas URLs en **un solo objeto JSON unificado**, asegurando:
+Consolida los duplicados que aún quedan (mismas sedes, planes o disciplinas escritas de forma distinta) en **un solo objeto JSON unificado**, asegurando:
 
 1. **Integridad:** No pierdas información relevante de ningún fragmento.
 2. **Consistencia:** Unifica formato, tipos de datos y nombres de sedes.
@@ -579,24 +1627,32 @@ lo más precisa posible (calle, número, distrito, ciudad). Asumir que no es pro
     Devuelve solo el JSON final. No incluyas explicaciones ni comentarios.
     🚫 Importante: No devuelvas el JSON dentro de bloques de código ni uses comillas triples. Solo devuelve el objeto JSON plano.
     """
-    logging.info("Merging all gym scraped information ...")
-    response = client.chat.completions.create(
-        model="gpt-5-nano",
-        messages=[
-            {"role": "system", "content": "Eres un asistente experto en fusión y deduplicación de datos JSON."},
-            {"role": "user", "content": prompt},
-        ],
-        response_format={"type": "json_object"}
-    )
+    log.info("Merging all gym scraped information ...")
+    messages = [
+        {"role": "system", "content": "Eres un asistente experto en fusión y deduplicación de datos JSON."},
+        {"role": "user", "content": prompt},
+    ]
+    for attempt in range(VALIDATION_MAX_RETRIES + 1):
+        response = client.chat.completions.create(
+            model="gpt-5-nano",
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
 
-    text_output = response.choices[0].message.content.strip()
-    if not text_output.strip().endswith(']') and not text_output.strip().endswith('}'):
-        logging.warning("⚠️ Output truncated, requesting continuation...")
-    try:
-        return json.loads(text_output)
-    except json.JSONDecodeError:
-        logging.warning("⚠️ El modelo devolvió texto no válido. Retornando texto crudo.")
-        return {"raw_output": text_output}
+        text_output = (response.choices[0].message.content or "").strip()
+        if not text_output.endswith(']') and not text_output.endswith('}'):
+            log.warning("⚠️ Output truncated, requesting continuation...")
+        try:
+            return MergedGymData.model_validate_json(text_output).model_dump()
+        except ValidationError as ve:
+            if attempt == VALIDATION_MAX_RETRIES:
+                break
+            log.warning("⚠️ Invalid merge output (%s errors), retrying...", ve.error_count())
+            messages.extend(_validation_feedback(text_output, ve))
+            time.sleep(1.0 * (attempt + 1))
+
+    log.warning("⚠️ El modelo devolvió texto no válido. Retornando los datos deduplicados localmente.")
+    return {"gym": gym_name, **deduped}
 
 
 if __name__ == "__main__":
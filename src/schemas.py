@@ -0,0 +1,117 @@
+from typing import Annotated, Any
+
+from pydantic import AfterValidator, BaseModel, ConfigDict
+
+
+def _not_blank(value: str) -> str:
+    if not value.strip():
+        raise ValueError("must not be blank")
+    return value
+
+
+# Enforced on our side only (the validator does not show up in the JSON schema), so a blank
+# value sends the response through the sanitizer, which regenerates it.
+SearchContent = Annotated[str, AfterValidator(_not_blank)]
+
+
+class _Fact(BaseModel):
+    # Strict structured outputs require additionalProperties: false on every object
+    model_config = ConfigDict(extra="forbid")
+
+    content_para_busqueda: SearchContent
+
+
+class Ubicacion(_Fact):
+    direccion_completa: str
+    distrito: str
+    horario_atencion: str
+
+
+class Precio(_Fact):
+    sede: str
+    descripcion_plan: str
+    valor: float | None
+    moneda: str
+    recurrencia: str
+
+
+class Horario(_Fact):
+    sede: str
+    nombre_clase: str
+    instructor: str
+    fecha: str
+    dia_semana: str
+    hora_inicio: str
+    hora_fin: str
+
+
+class Disciplina(_Fact):
+    nombre: str
+    descripcion: str
+
+
+class GymFacts(BaseModel):
+    """Shape of a single page's extraction output."""
+    model_config = ConfigDict(extra="forbid")
+
+    ubicaciones: list[Ubicacion]
+    precios: list[Precio]
+    horarios: list[Horario]
+    disciplinas: list[Disciplina]
+
+
+class FrameFacts(GymFacts):
+    """
+    Extraction output for one fragment (e.g. an iframe) of a multi-fragment request. `index` is the
+    number of its "Fragmento N" section: echoed URLs can differ from the input (slashes, escaping).
+    """
+    index: int
+
+
+class GymFactsBatch(BaseModel):
+    """Shape of a multi-fragment extraction output: one entry per fragment."""
+    model_config = ConfigDict(extra="forbid")
+
+    frames: list[FrameFacts]
+
+
+GYM_FACTS_RESPONSE_FORMAT: dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "gym_facts",
+        "schema": GymFacts.model_json_schema(),
+        "strict": True,
+    },
+}
+
+GYM_FACTS_BATCH_RESPONSE_FORMAT: dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "gym_facts_batch",
+        "schema": GymFactsBatch.model_json_schema(),
+        "strict": True,
+    },
+}
+
+
+class MergedGymData(BaseModel):
+    """
+    Shape of the merge step's output. Facts are kept as plain dicts: the merge prompt may
+    drop or add fields, and the per-page extraction already validated their contents.
+    """
+    gym: str = ""
+    ubicaciones: list[dict[str, Any]] = []
+    precios: list[dict[str, Any]] = []
+    horarios: list[dict[str, Any]] = []
+    disciplinas: list[dict[str, Any]] = []
+
+
+class UrlCategorization(BaseModel):
+    """
+    Shape of the URL categorization output: the list indices of the URLs in each category.
+    JSON mode only guarantees valid JSON, so the reply is validated before it is mapped or cached.
+    """
+    locations: list[int] = []
+    pricing: list[int] = []
+    schedules: list[int] = []
+    disciplines: list[int] = []
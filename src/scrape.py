@@ -1,15 +1,78 @@
+import argparse
+import asyncio
+import atexit
+import contextlib
 import logging
+import logging.handlers
 import os
 import re
-import locale
+import queue
+import threading
+from typing import Callable, Iterator, TypeVar
 
 import openai
 from dotenv import load_dotenv
+from lxml import etree
+from lxml import html as lxml_html
 from playwright.sync_api import sync_playwright, Page
-from bs4 import BeautifulSoup
-from src.sitemap_utils import get_filtered_sitemap_urls
+from src.cache_utils import ExtractionCache, UrlCategoryIndex
+from src.sitemap_utils import SitemapEntry, get_filtered_sitemap_urls_async
+from src.url_utils import canonicalize_url
 from src.db_utils import bulk_insert, get_connection, init_db
-from src.llm import categorize_urls_with_llm, extract_structured_data, merge_gym_data_with_llm
+from src.llm import (
+    BATCH_EXTRACTION_THRESHOLD,
+    categorize_urls_async,
+    create_async_client,
+    create_client,
+    extract_many,
+    extract_structured_data_batch,
+    merge_gym_data_with_llm,
+    submit_batch_extraction_async,
+)
+
+log = logging.getLogger(__name__)
+
+# Each worker thread drives its own browser for the whole run; OpenAI calls are bounded by the same number
+SCRAPE_WORKERS = 4
+
+T = TypeVar("T")
+
+# Un parser lxml por hilo: una misma instancia no debe usarse desde varios workers a la vez
+_PARSERS = threading.local()
+_NOISE_TAGS = ("script", "style", "svg", "nav", "footer", "header", "noscript")
+# Recursos que el pruning descarta de todos modos. Las hojas de estilo se cargan igual: sin ellas cambia
+# el layout y los iframes con lazy loading pueden no entrar nunca en el viewport al hacer scroll
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+_LINE_BREAKS_RE = re.compile(r"[\n\r\t]+")
+_REPEATED_WS_RE = re.compile(r"\s{2,}")
+
+# Mismo criterio que el bucle en Python (conteo estable durante `stableChecks` ticks), pero sin un
+# round-trip por tick: la página hace scroll y cuenta iframes por sí sola hasta estabilizar o agotar el tiempo
+_SCROLL_UNTIL_IFRAMES_JS = """
+({maxScrolls, step, stableChecks, tickMs, maxMs}) => new Promise(resolve => {
+    const start = Date.now();
+    let last = 0, stable = 0, scrolls = 0;
+    const tick = () => {
+        const count = document.querySelectorAll("iframe").length;
+        if (count === last) {
+            stable += 1;
+        } else {
+            stable = 0;
+            last = count;
+        }
+        if (stable >= stableChecks && count > 0) {
+            return resolve({count, scrolls, stable: true});
+        }
+        if (scrolls >= maxScrolls || Date.now() - start >= maxMs) {
+            return resolve({count: last, scrolls, stable: false});
+        }
+        window.scrollBy(0, step);
+        scrolls += 1;
+        setTimeout(tick, tickMs);
+    };
+    tick();
+})
+"""
 
 pages_to_scrape = {
     "bioritmo": "https://www.bioritmo.com.pe/",
@@ -38,178 +101,468 @@ def should_skip_frame(frame):
     return any(domain in frame.url for domain in skip_domains)
 
 
-def scroll_until_iframes(page: Page, max_scrolls: int = 30, scroll_step: int = 1000, stable_checks: int = 3):
+def scroll_until_iframes(page: Page, max_scrolls: int = 30, scroll_step: int = 1000, stable_checks: int = 3,
+                         tick_ms: int = 200, max_ms: int = 15000) -> int:
     """
     Hace scroll progresivo hasta que los iframes dejan de aumentar.
+    Todo el bucle corre dentro de la página en un único page.evaluate, con un tope de `max_ms`.
     Retorna el número final de iframes encontrados.
     """
-    last_count = 0
-    stable_counter = 0
-
-    for i in range(max_scrolls):
-        iframes_count = len(page.query_selector_all("iframe"))
-        logging.info(f"🔎 Scroll {i+1}/{max_scrolls}: found {iframes_count} iframes")
-
-        if iframes_count == last_count:
-            stable_counter += 1
-        else:
-            stable_counter = 0
-            last_count = iframes_count
+    result = page.evaluate(_SCROLL_UNTIL_IFRAMES_JS, {
+        "maxScrolls": max_scrolls,
+        "step": scroll_step,
+        "stableChecks": stable_checks,
+        "tickMs": tick_ms,
+        "maxMs": max_ms,
+    })
+    if result["stable"]:
+        log.info("✅ Iframes stabilized at %s after %s scrolls", result["count"], result["scrolls"])
+    else:
+        log.info("🔎 Stopped scrolling after %s scrolls: found %s iframes", result["scrolls"], result["count"])
+    return result["count"]
 
-        if stable_counter >= stable_checks and iframes_count > 0:
-            logging.info(f"✅ Iframes stabilized at {iframes_count} after {i+1} scrolls")
-            break
 
-        page.mouse.wheel(0, scroll_step)
-        page.wait_for_timeout(1000)
-    return last_count
+def _block_heavy_resources(route) -> None:
+    if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
 
 
-def flatten_nested_divs_regex(html: str) -> str:
+@contextlib.contextmanager
+def track_in_flight_requests(page: Page) -> Iterator[set]:
     """
-    Colapsa wrappers <div><div>...</div></div> hasta dejar solo <div>...</div>.
-    Funciona de forma iterativa y es segura para fragments.
+    Registra los requests en curso de la página mientras dure el bloque. Hay que abrirlo antes de
+    `page.goto`, para que los requests lanzados durante la navegación (incluidos los documentos de
+    los iframes) también se cuenten.
     """
-    if not html:
-        return html
+    in_flight = set()
+
+    def on_request(request):
+        in_flight.add(request)
 
-    prev = None
-    out = html
+    def on_request_done(request):
+        in_flight.discard(request)
 
-    # Paso 1: normalizar un poco espacios entre etiquetas
-    out = re.sub(r'>\s+<', '><', out)
+    page.on("request", on_request)
+    page.on("requestfinished", on_request_done)
+    page.on("requestfailed", on_request_done)
+    try:
+        yield in_flight
+    finally:
+        page.remove_listener("request", on_request)
+        page.remove_listener("requestfinished", on_request_done)
+        page.remove_listener("requestfailed", on_request_done)
 
-    # Iteramos hasta convergencia
-    while prev != out:
-        prev = out
-        # 1) Colapsar aperturas: <div ...><div ...> -> <div>
-        out = re.sub(r'<div\b[^>]*>\s*<div\b[^>]*>', '<div>', out, flags=re.IGNORECASE)
 
-        # 2) Colapsar cierres: </div></div> -> </div>
-        out = re.sub(r'</div>\s*</div>', '</div>', out, flags=re.IGNORECASE)
+def wait_for_network_quiet(page: Page, in_flight: set, idle_ms: int = 500, timeout_ms: int = 5000,
+                           poll_ms: int = 100) -> None:
+    """
+    Espera a que la página pase `idle_ms` sin requests en curso (según `track_in_flight_requests`),
+    como máximo `timeout_ms`. Reemplaza a wait_until="networkidle", que en sitios con trackers o
+    long-polling puede tardar segundos de más o no resolverse nunca.
+    """
+    quiet_ms = waited_ms = 0
+    while quiet_ms < idle_ms and waited_ms < timeout_ms:
+        page.wait_for_timeout(poll_ms)  # los eventos de red se procesan durante la espera
+        waited_ms += poll_ms
+        quiet_ms = 0 if in_flight else quiet_ms + poll_ms
 
-    # Opcional: limpiar repetidos de espacios y newlines
-    out = re.sub(r'\s+', ' ', out).strip()
 
-    return out
+def _find_main_container(doc: lxml_html.HtmlElement, keywords: list[str] | None) -> lxml_html.HtmlElement | None:
+    """
+    Returns <main>, the first role="main" element or, if keywords are given, the <div>/<section>
+    whose text mentions them most often.
+    """
+    for container in doc.iterfind(".//main"):
+        return container
+    for container in doc.iterfind(".//*[@role='main']"):
+        return container
+    if not keywords:
+        return None
+
+    lowered_keywords = [kw.lower() for kw in keywords]
+
+    def count_hits(text: str | None) -> int:
+        if not text:
+            return 0
+        text = text.lower()
+        return sum(text.count(kw) for kw in lowered_keywords)
+
+    # Each text node is scanned once and its hits are summed bottom-up, instead of re-reading
+    # every candidate's whole subtree. Reverse document order visits children before parents.
+    scores = {}
+    for node in reversed(list(doc.iter(etree.Element))):
+        scores[node] = count_hits(node.text) + sum(count_hits(child.tail) + scores[child] for child in node)
+
+    best_candidate, max_score = None, 0
+    for node in doc.iter("div", "section"):
+        if scores[node] > max_score:
+            best_candidate, max_score = node, scores[node]
+    return best_candidate
+
+
+def _collapse_redundant_divs(root: lxml_html.HtmlElement) -> None:
+    """Replaces every <div> below `root` whose only content is a single <div> with that child, in one walk."""
+    for div in list(root.iterdescendants("div")):
+        if len(div) != 1 or (div.text or "").strip():
+            continue
+        child = div[0]
+        if child.tag != "div" or (child.tail or "").strip():
+            continue
+        child.tail = div.tail
+        div.getparent().replace(div, child)
+
+
+def _html_parser() -> lxml_html.HTMLParser:
+    parser = getattr(_PARSERS, "html", None)
+    if parser is None:
+        # Parse from UTF-8 bytes so documents that still carry an XML encoding declaration are accepted
+        parser = _PARSERS.html = lxml_html.HTMLParser(encoding="utf-8", remove_comments=True)
+    return parser
 
 
 def prune_html_for_llm(html_content: str, keywords: list[str] = None) -> str:
     """
-    Cleans HTML for LLM input using BeautifulSoup:
+    Cleans HTML for LLM input using lxml:
     - Keeps only the main container (based on <main>, role="main", or keyword relevance)
-    - Removes scripts, styles, SVGs, etc.
+    - Removes scripts, styles, SVGs, comments, etc.
     - Removes all attributes from tags
     - Collapses redundant <div><div>...</div></div>
     - Removes \n, \t, and redundant spaces
     """
-    soup = BeautifulSoup(html_content, "html.parser")
+    if not html_content or not html_content.strip():
+        return ""
+    try:
+        doc = lxml_html.document_fromstring(html_content.encode("utf-8"), parser=_html_parser())
+    except etree.ParserError:
+        return ""
 
     # 1. Locate main content
-    main_container = soup.find("main") or soup.find(attrs={"role": "main"})
-    if not main_container and keywords:
-        candidates = soup.find_all(["div", "section"])
-        best_candidate, max_score = None, 0
-        for node in candidates:
-            text = node.get_text(" ", strip=True).lower()
-            score = sum(text.count(kw.lower()) for kw in keywords)
-            if score > max_score:
-                best_candidate, max_score = node, score
-        if best_candidate:
-            main_container = best_candidate
-    root = main_container if main_container else soup.body or soup
+    root = _find_main_container(doc, keywords)
+    if root is None:
+        root = doc.find("body")
+    if root is None:
+        root = doc
 
     # 2. Remove unwanted tags
-    for tag in ["script", "style", "svg", "nav", "footer", "header", "noscript"]:
-        for el in root.find_all(tag):
-            el.decompose()
+    etree.strip_elements(root, *_NOISE_TAGS, with_tail=False)
+    # Nothing left for the model to read (e.g. an iframe whose document is still <html></html>)
+    if not root.text_content().strip():
+        return ""
 
     # 3. Remove all attributes from remaining tags
-    for tag in root.find_all(True):
-        tag.attrs = {}
+    for el in root.iter(etree.Element):
+        el.attrib.clear()
 
     # 4. Collapse redundant nested divs like <div><div>...</div></div>
-    def collapse_redundant_divs(soup_node):
-        changed = True
-        while changed:
-            changed = False
-            for div in soup_node.find_all("div"):
-                children = [child for child in div.children if child.name or str(child).strip()]
-                if len(children) == 1 and children[0].name == "div":
-                    div.replace_with(children[0])
-                    changed = True
-                    break
-
-    collapse_redundant_divs(root)
+    _collapse_redundant_divs(root)
 
     # 5. Get cleaned HTML as string
-    html_clean = str(root)
+    html_clean = etree.tostring(root, encoding="unicode", method="html", with_tail=False)
 
     # 6. Remove tabs, newlines, and normalize whitespace
-    html_clean = re.sub(r"[\n\r\t]+", " ", html_clean)
-    html_clean = re.sub(r"\s{2,}", " ", html_clean).strip()
+    html_clean = _LINE_BREAKS_RE.sub(" ", html_clean)
+    html_clean = _REPEATED_WS_RE.sub(" ", html_clean).strip()
 
     return html_clean
 
 
-def scrape_single_url(client: openai.OpenAI, page: Page, url: dict[str, str], url_type: str, gym_name: str) -> dict[str, dict]:
+def collect_page_fragments(page: Page, url_str: str) -> list[tuple[str, str]]:
+    """
+    Navega a una URL y retorna (url, html podado) de cada iframe relevante que contenga,
+    incluido el documento principal.
+    """
+    with track_in_flight_requests(page) as in_flight:
+        page.goto(url_str, wait_until="domcontentloaded", timeout=180000)
+        scroll_until_iframes(page)
+        wait_for_network_quiet(page, in_flight)
+
+    fragments = []
+    retry_urls = []
+    seen = set()
+    # 3. Procesar los iframes relevantes, leyendo el DOM que Playwright ya tiene cargado
+    for frame in page.frames:
+        # Heurística para decidir si un iframe es interesante
+        if frame.url == 'about:blank': continue
+        if should_skip_frame(frame):
+            continue
+        # Un mismo widget (p. ej. el calendario) suele repetirse en varias secciones de la página
+        canonical_url = canonicalize_url(frame.url)
+        if canonical_url in seen:
+            continue
+        seen.add(canonical_url)
+        log.info("Found relevant iframe. Scraping: %s", frame.url)
+        try:
+            pruned_frame_html = prune_html_for_llm(frame.content())
+        except Exception as e:
+            log.warning("⚠️ Could not read iframe %s in place: %s", frame.url, e)
+            pruned_frame_html = ""
+
+        if pruned_frame_html.strip():
+            fragments.append((frame.url, pruned_frame_html))
+        else:
+            retry_urls.append(frame.url)
+
+    # Solo para los frames sin DOM disponible: navegar a su URL. Va al final porque reemplaza
+    # la página actual y desconecta el resto de sus frames.
+    for frame_url in retry_urls:
+        try:
+            with track_in_flight_requests(page) as in_flight:
+                page.goto(frame_url, wait_until="domcontentloaded", timeout=45000)
+                wait_for_network_quiet(page, in_flight)
+            pruned_frame_html = prune_html_for_llm(page.content())
+            if pruned_frame_html.strip():
+                fragments.append((frame_url, pruned_frame_html))
+        except Exception as e:
+            log.error("❌ Failed to scrape iframe %s: %s", frame_url, e)
+    return fragments
+
+
+def scrape_single_url(client: openai.OpenAI, page: Page, url: SitemapEntry, url_type: str, gym_name: str,
+                      cache: ExtractionCache | None = None) -> dict[str, dict]:
     """
     Raspa una URL y cualquier iframe relevante que contenga
     """
-    url_str = url["loc"]
-    lastmod = url["lastmod"]
-    freq = url["changefreq"]
-    logging.info(f" -> Scraping URL principal: {url_str}")
+    url_str = url.loc
+    lastmod = url.lastmod
+    freq = url.changefreq
+    log.info(" -> Scraping URL principal: %s", url_str)
 
     chunks_data = {}
 
     try:
-        page.goto(url_str, wait_until="domcontentloaded", timeout=180000)
-        scroll_until_iframes(page)
-
-        # 3. Procesar los iframes relevantes
-        for frame in page.frames:
-            # Heurística para decidir si un iframe es interesante
-            if frame.url == 'about:blank': continue
-            if should_skip_frame(frame):
-                continue
-            logging.info(f"Found relevant iframe. Scraping: {frame.url}")
-            try:
-                try:
-                    page.goto(frame.url, wait_until="networkidle", timeout=45000)
-                except Exception:
-                    page.goto(frame.url, wait_until="domcontentloaded", timeout=45000)
-                frame_html = page.content()
-                pruned_frame_html = prune_html_for_llm(frame_html)
-
-                if pruned_frame_html.strip():
-                    logging.info(f"Extracting from iframe content...")
-                    iframe_data = extract_structured_data(client, frame.url, "iframe_content", pruned_frame_html,
-                                                          gym_name, lastmod, freq)
-                    # Fusionar datos del iframe
-                    if iframe_data:
-                        chunks_data[frame.url] = iframe_data
-            except Exception as e:
-                logging.error(f"❌ Failed to scrape iframe {frame.url}: {e}")
-
-        # Convertir los diccionarios acumulados de nuevo a listas
+        fragments = collect_page_fragments(page, url_str)
+
+        # Extraer todos los iframes de la página con la menor cantidad de llamadas posible
+        log.info("Extracting from %s iframes...", len(fragments))
+        extracted = extract_structured_data_batch(client, fragments, "iframe_content", gym_name, lastmod, freq, cache)
+        for frame_url, iframe_data in extracted.items():
+            # Fusionar datos del iframe
+            if iframe_data:
+                chunks_data[frame_url] = iframe_data
         return chunks_data
 
     except Exception as e:
-        logging.error(f"❌ Failed to scrape main URL {url}: {e}")
-        return {"ubicaciones": [], "precios": [], "horarios": [], "disciplinas": []}
+        log.error("❌ Failed to scrape main URL %s: %s", url, e)
+        return chunks_data
+
+
+class ScrapeWorkerPool:
+    """
+    Pool de hilos que raspan URLs en paralelo durante toda la ejecución. Cada hilo tiene su propia
+    instancia de Playwright y su navegador (la API síncrona no se puede compartir entre hilos), y abre
+    un contexto nuevo con una sola página por cada llamada a `map`, es decir, por gimnasio.
+    """
+
+    def __init__(self, workers: int = SCRAPE_WORKERS):
+        self._jobs = queue.Queue()
+        self._generation = 0
+        self._startup_errors = []
+        self._threads = []
+        for _ in range(max(1, workers)):
+            ready = threading.Event()
+            thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+            thread.start()
+            ready.wait()
+            self._threads.append(thread)
+        if self._startup_errors:
+            self.close()
+            raise self._startup_errors[0]
+
+    def __enter__(self) -> "ScrapeWorkerPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _run(self, ready: threading.Event) -> None:
+        try:
+            playwright = sync_playwright().start()
+            browser = playwright.chromium.launch(headless=True)
+        except Exception as e:
+            self._startup_errors.append(e)
+            ready.set()
+            return
+        ready.set()
+
+        context, page, generation = None, None, None
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    self._jobs.task_done()
+                    return
+                job_generation, scrape, results, index, url, url_type = job
+                try:
+                    if job_generation != generation:
+                        # Contexto nuevo por gimnasio: cookies y storage aislados, una sola página reutilizada
+                        if context is not None:
+                            context.close()
+                        context = browser.new_context()
+                        context.route("**/*", _block_heavy_resources)
+                        page = context.new_page()
+                        generation = job_generation
+                    results[index] = scrape(page, url, url_type)
+                except Exception as e:
+                    log.error("❌ Worker failed on %s: %s", url.loc, e)
+                finally:
+                    self._jobs.task_done()
+        finally:
+            browser.close()
+            playwright.stop()
+
+    def map(self, filtered_urls: dict[str, list[SitemapEntry]], scrape: Callable[[Page, SitemapEntry, str], T]) -> list[T]:
+        """
+        Aplica `scrape(page, url, url_type)` a todas las URLs categorizadas de un gimnasio.
+        Retorna los resultados no vacíos en el mismo orden que `filtered_urls`.
+        """
+        self._generation += 1
+        tasks = [(sub_url, url_type) for url_type, sub_urls in filtered_urls.items() for sub_url in sub_urls]
+        results: list[T | None] = [None] * len(tasks)
+        for index, (sub_url, url_type) in enumerate(tasks):
+            self._jobs.put((self._generation, scrape, results, index, sub_url, url_type))
+        self._jobs.join()
+        return [result for result in results if result]
+
+    def close(self) -> None:
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+async def categorize_site(client: openai.AsyncOpenAI, site_url: str, cache: ExtractionCache | None,
+                          url_index: UrlCategoryIndex | None, strict: bool,
+                          http_cache: ExtractionCache | None = None) -> dict[str, list[SitemapEntry]]:
+    log.info("Scraping %s", site_url)
+    urls_to_scrape = await get_filtered_sitemap_urls_async(site_url, http_cache)
+    log.info("URLs obtained: %s", urls_to_scrape)
+    filtered_urls = await categorize_urls_async(urls_to_scrape, client, cache, url_index, strict)
+    filtered_urls["homepage"] = [SitemapEntry(site_url)]
+    log.info("Categorized URLs: %s", filtered_urls)
+    return filtered_urls
+
+
+def store_gym_data(client: openai.OpenAI, gym_name: str, extracted_pages: list[dict[str, dict]]) -> None:
+    """
+    Fusiona lo extraído de todas las páginas de un gimnasio y lo guarda en la base de datos.
+    """
+    schedules = []
+    chunked_data = {}
+    for extracted_data in extracted_pages:
+        for url, chunk_data in extracted_data.items():
+            # separar datos de horarios para no hacer merge de estos, sin modificar la entrada
+            schedules.extend(chunk_data.get("horarios") or [])
+            chunked_data[url] = {category: facts for category, facts in chunk_data.items() if category != "horarios"}
+    merged_gym_data = merge_gym_data_with_llm(gym_name, chunked_data, client)
+    merged_gym_data["horarios"] = schedules  # recuperar data de horarios
+    conn = get_connection()
+    bulk_insert(conn, gym_name, merged_gym_data)
+
+
+async def extract_sites_with_batch(
+        client: openai.AsyncOpenAI,
+        sites: dict[str, list[tuple[SitemapEntry, str, list[tuple[str, str]]]]],
+        cache: ExtractionCache | None = None
+) -> dict[str, list[dict[str, dict]]]:
+    """
+    Extrae los fragmentos recolectados de todos los gimnasios en un solo Batch de OpenAI (o de forma
+    interactiva y concurrente con `extract_many` si son menos de `BATCH_EXTRACTION_THRESHOLD`), y los
+    devuelve agrupados por gimnasio en el mismo formato que `scrape_single_url`.
+
+    Args:
+        sites: gym_name -> lista de (url, url_type, fragmentos) por página raspada.
+    """
+    # custom_id debe ser único en el batch: un mismo iframe (p. ej. un widget compartido) se extrae una vez
+    pages = {}
+    for gym_name, scraped in sites.items():
+        for url, url_type, fragments in scraped:
+            for frame_url, html_content in fragments:
+                pages.setdefault(frame_url, {
+                    "page_url": frame_url,
+                    "url_type": url_type,
+                    "html_content": html_content,
+                    "gym_name": gym_name,
+                    "lastmod": url.lastmod,
+                    "freq": url.changefreq,
+                })
+
+    if len(pages) >= BATCH_EXTRACTION_THRESHOLD:
+        results = await submit_batch_extraction_async(client, list(pages.values()), cache=cache)
+    else:
+        log.info("Only %s pages to extract, skipping the Batch API", len(pages))
+        results = {}
+        for frame_url, extracted in zip(pages, await extract_many(client, list(pages.values()), cache=cache)):
+            if isinstance(extracted, BaseException):
+                log.error("❌ Failed to extract %s: %s", frame_url, extracted)
+            else:
+                results[frame_url] = extracted
+
+    return {
+        gym_name: [
+            # Copia por página: un mismo iframe puede aparecer en varias páginas o gimnasios
+            {frame_url: dict(results[frame_url]) for frame_url, _ in fragments if results.get(frame_url)}
+            for _, _, fragments in scraped
+        ]
+        for gym_name, scraped in sites.items()
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Scrape gym websites into PostgreSQL.")
+    parser.add_argument(
+        "--cache-dir",
+        default=os.getenv("SCRAPE_CACHE_DIR"),
+        help="Directory for the on-disk LLM response cache (disabled if not set).",
+    )
+    parser.add_argument(
+        "--strict-categorization",
+        action="store_true",
+        help="Categorize URLs with the keyword prefilter only, never calling the LLM for ambiguous URLs.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("SCRAPE_WORKERS", SCRAPE_WORKERS)),
+        help="Number of browsers scraping URLs in parallel.",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Scrape every site first and extract all pages through the OpenAI Batch API (cheaper, up to 24h).",
+    )
+    return parser.parse_args(argv)
+
+
+def setup_logging() -> None:
+    """
+    Sends every log record through a queue and writes them to stderr from a single listener
+    thread, so concurrent workers never contend on the stream lock.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
 
 
 def main():
+    # Antes que todo lo demás, para no perder los logs de arranque (p. ej. los de init_db)
+    setup_logging()
+    args = parse_args()
     if not os.getenv("OPENAI_API_KEY"):
         load_dotenv("../.env")  # local dev
     with get_connection() as conn:
         init_db(conn)
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
     custom_urls_env = os.getenv("SCRAPE_URLS")
     if custom_urls_env:
         try:
@@ -218,49 +571,49 @@ def main():
             pages_to_scrape_used = {}
             for pair in pairs:
                 if ":" not in pair:
-                    logging.warning(f"⚠️ Invalid entry (missing colon): {pair}")
+                    log.warning("⚠️ Invalid entry (missing colon): %s", pair)
                     continue
                 name, url = pair.split(":", 1)
                 pages_to_scrape_used[name.strip()] = url.strip()
-            logging.info(f"⚙️ Using URLs from environment: {pages_to_scrape}")
+            log.info("⚙️ Using URLs from environment: %s", pages_to_scrape)
         except Exception as e:
-            logging.warning(f"⚠️ Failed to parse SCRAPE_URLS: {e}")
+            log.warning("⚠️ Failed to parse SCRAPE_URLS: %s", e)
             pages_to_scrape_used = pages_to_scrape
     else:
         pages_to_scrape_used = pages_to_scrape
-    client = openai.Client()
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        for gym_name, site_url in pages_to_scrape_used.items():
-            logging.info(f"Scraping {site_url}")
-            urls_to_scrape = get_filtered_sitemap_urls(site_url)
-            schedules = []
-            logging.info(f"URLs obtained: {urls_to_scrape}")
-            filtered_urls = categorize_urls_with_llm(urls_to_scrape, client)
-            filtered_urls["homepage"] = [{"loc": site_url, "lastmod": None, "changefreq": None, "priority": None}]
-            logging.info(f"Categorized URLs: {filtered_urls}")
-            chunked_data = {}
-            for page_type, sub_urls in filtered_urls.items():
-                page = browser.new_page()
-                try:
-                    for sub_url in sub_urls:
-                        # if sub_url["loc"] != 'https://www.bioritmo.com.pe/horarios-treinos/santa-cruz':
-                        #     continue
-                        extracted_data = scrape_single_url(client, page, sub_url, page_type, gym_name)
-                        for url, chunk_data in extracted_data.items():
-                            if chunk_data.get("horarios"):
-                                schedules.extend(chunk_data.pop("horarios"))  # separar datos de horarios para no hacer merge de estos
-                        chunked_data = chunked_data | extracted_data
-                except Exception as e:
-                    logging.error(e)
-                finally:
-                    page.close()
-            merged_gym_data = merge_gym_data_with_llm(gym_name, chunked_data, client)
-            merged_gym_data["horarios"] = schedules  # recuperar data de horarios
-            conn = get_connection()
-            bulk_insert(conn, gym_name, merged_gym_data)
-        browser.close()
-    logging.info("Scraping complete.")
+    client = create_client()
+    cache = ExtractionCache(args.cache_dir) if args.cache_dir else None
+    url_index = UrlCategoryIndex(os.path.join(args.cache_dir, "url_categories")) if args.cache_dir else None
+    http_cache = ExtractionCache(os.path.join(args.cache_dir, "http")) if args.cache_dir else None
+    # Un solo event loop para toda la ejecución: el pool de conexiones del cliente async queda ligado a él
+    with asyncio.Runner() as runner, ScrapeWorkerPool(args.workers) as pool:
+        async_client = create_async_client()
+        try:
+            if args.batch:
+                # Fase 1: raspar todos los sitios sin llamar al LLM; fase 2: un solo batch; fase 3: merge por gimnasio
+                sites = {}
+                for gym_name, site_url in pages_to_scrape_used.items():
+                    filtered_urls = runner.run(categorize_site(
+                        async_client, site_url, cache, url_index, args.strict_categorization, http_cache))
+                    sites[gym_name] = pool.map(
+                        filtered_urls,
+                        lambda page, url, url_type: (url, url_type, collect_page_fragments(page, url.loc)),
+                    )
+                extracted_sites = runner.run(extract_sites_with_batch(async_client, sites, cache))
+                for gym_name, extracted_pages in extracted_sites.items():
+                    store_gym_data(client, gym_name, extracted_pages)
+            else:
+                for gym_name, site_url in pages_to_scrape_used.items():
+                    filtered_urls = runner.run(categorize_site(
+                        async_client, site_url, cache, url_index, args.strict_categorization, http_cache))
+                    extracted_pages = pool.map(
+                        filtered_urls,
+                        lambda page, url, url_type: scrape_single_url(client, page, url, url_type, gym_name, cache),
+                    )
+                    store_gym_data(client, gym_name, extracted_pages)
+        finally:
+            runner.run(async_client.close())
+    log.info("Scraping complete.")
 
 
 if __name__ == "__main__":
@@ -1,127 +1,539 @@
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
 import logging
+import os
+import re
+import time
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator
 
 import httpx
-import xml.etree.ElementTree as ET
+from lxml import etree
 from urllib.parse import urlparse, urljoin
 
+from src.cache_utils import ExtractionCache
 
-def get_filtered_sitemap_urls(base_url: str) -> list[dict]:
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def _entry_json(entry: "SitemapEntry") -> bytes:
+        # orjson serializes dataclasses (slotted ones included) natively, without an intermediate dict
+        return orjson.dumps(entry)
+except ImportError:
+    def _entry_json(entry: "SitemapEntry") -> bytes:
+        return json.dumps(asdict(entry), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# Child sitemaps of an index fetched at the same time
+MAX_CONCURRENT_SITEMAP_FETCHES = 8
+# Politeness per host: at most this many requests at once, started at least this many seconds apart
+MAX_CONCURRENT_FETCHES_PER_HOST = 2
+HOST_FETCH_DELAY = 0.1
+# Sitemaps of a site usually share a host: over HTTP/2 they are multiplexed on one kept-alive connection
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30)
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+_URL_TAG = f"{{{SITEMAP_NS}}}url"
+_SITEMAP_TAG = f"{{{SITEMAP_NS}}}sitemap"
+# Position of each <url> child in the (loc, lastmod, changefreq, priority) fields of a SitemapEntry
+_FIELD_INDEX = {
+    f"{{{SITEMAP_NS}}}{field}": i for i, field in enumerate(("loc", "lastmod", "changefreq", "priority"))
+}
+_GZIP_MAGIC = b"\x1f\x8b"
+# A checkpoint older than this is ignored: the crawl that wrote it is not resumed, the sitemaps are fetched again
+CHECKPOINT_TTL_SECONDS = 24 * 60 * 60
+# "Sitemap: <url>" directive of a robots.txt line
+_SITEMAP_LINE = re.compile(r"[ \t]*sitemap[ \t]*:[ \t]*(\S+)", re.IGNORECASE)
+
+
+@dataclass(slots=True, frozen=True)
+class SitemapEntry:
+    """A page listed in a sitemap, with the optional metadata of its <url> element."""
+    loc: str
+    lastmod: str | None = None
+    changefreq: str | None = None
+    priority: str | None = None
+
+
+def _entry_fields(elem: etree._Element) -> list[str | None]:
     """
-    Finds the sitemap from a site's robots.txt, fetches all page URLs with their metadata
-    (lastmod, changefreq, priority), and returns a unique list filtered to the base domain.
+    Reads loc, lastmod, changefreq and priority of a <url>/<sitemap> element in a single walk over its
+    children, dispatching on their fully qualified tag. The first occurrence of a field wins.
+    """
+    fields = [None, None, None, None]
+    for child in elem:
+        i = _FIELD_INDEX.get(child.tag)
+        if i is not None and fields[i] is None:
+            fields[i] = (child.text or "").strip()
+    return fields
 
-    Args:
-        base_url: The starting URL of the website (e.g., "https://bioritmo.com.pe").
 
-    Returns:
-        A list of dicts: [{"loc": str, "lastmod": Optional[str], "changefreq": Optional[str], "priority": Optional[str]}]
+def _revalidation(url: str, cache: ExtractionCache) -> tuple[str, dict | None, dict[str, str]]:
+    """Returns the cache key of `url`, its cached copy (if any) and the headers that revalidate it."""
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    cached = cache.get(key)
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    return key, cached, headers
+
+
+def _store_validated(cache: ExtractionCache, key: str, url: str, response: httpx.Response, body: bytes) -> None:
+    etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    if response.status_code == 200 and (etag or last_modified):
+        cache.put(key, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": base64.b64encode(body).decode("ascii"),
+        }, {"url": url})
+
+
+@asynccontextmanager
+async def _conditional_stream(client: httpx.AsyncClient, url: str,
+                              cache: ExtractionCache | None) -> AsyncIterator[tuple[int, AsyncIterable[bytes]]]:
+    """
+    Streaming GET that revalidates a cached copy with If-None-Match / If-Modified-Since. Yields the
+    status code and an iterator over the body chunks. A 304 is answered from the cache as a 200, so
+    callers never see the difference, and a fresh body is stored once it has been read to the end.
+    Storing it means holding the whole body (plus its base64 copy) in memory, so that is only done
+    when the response carries an ETag or Last-Modified to revalidate it with.
+    """
+    key, cached, headers = _revalidation(url, cache) if cache is not None else (None, None, {})
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code == 304 and cached:
+            log.info("💾 %s not modified, using cached copy", url)
+            yield 200, _replay(base64.b64decode(cached["body"]))
+        elif (cache is not None and response.status_code == 200
+              and (response.headers.get("ETag") or response.headers.get("Last-Modified"))):
+            yield 200, _tee_into_cache(response, cache, key, url)
+        else:
+            yield response.status_code, response.aiter_bytes()
+
+
+async def _replay(body: bytes) -> AsyncIterator[bytes]:
+    yield body
+
+
+async def _tee_into_cache(response: httpx.Response, cache: ExtractionCache, key: str, url: str) -> AsyncIterator[bytes]:
+    # Buffers the whole body: the cache record is a single JSON document
+    chunks = []
+    async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        yield chunk
+    _store_validated(cache, key, url, response, b"".join(chunks))
+
+
+async def _iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Splits a streamed body into lines as the chunks arrive."""
+    pending = b""
+    async for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", "replace")
+    if pending:
+        yield pending.decode("utf-8", "replace")
+
+
+async def _gunzip(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Decompresses a gzipped body (e.g. sitemap.xml.gz served without Content-Encoding) chunk by chunk
+    as it arrives; any other body is passed through. Content-Encoding: gzip is already undone by httpx.
+    """
+    chunks = aiter(chunks)
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= len(_GZIP_MAGIC):
+            break
+
+    if not head.startswith(_GZIP_MAGIC):
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.decompress(head)
+    async for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+async def _iter_sitemap_elements(chunks: AsyncIterable[bytes]) -> AsyncIterator[etree._Element]:
+    """
+    Feeds the body chunks to a pull parser as they arrive and yields each <url>/<sitemap> element
+    as soon as it closes. Once the caller is done with an element, it is freed along with
+    everything parsed before it, so the parse tree stays small however large the sitemap is
+    (a body being teed into the HTTP cache is still buffered whole, see `_conditional_stream`).
+    """
+    parser = etree.XMLPullParser(events=("end",), tag=(_URL_TAG, _SITEMAP_TAG), resolve_entities=False)
+
+    def free(elem: etree._Element) -> None:
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    async for chunk in chunks:
+        parser.feed(chunk)
+        for _, elem in parser.read_events():
+            yield elem
+            free(elem)
+    parser.close()
+    for _, elem in parser.read_events():
+        yield elem
+        free(elem)
+
+
+class _HostFrontier:
+    """
+    Sitemap frontier with one FIFO queue per host. The next sitemap comes from the host that has been
+    idle the longest, and a host never gets more than `per_host` requests at once nor a new one sooner
+    than `delay` seconds after its previous one, so indexes sharded over several hosts (or a CDN) are
+    spread across them instead of triggering 429s on one.
+    """
+
+    def __init__(self, per_host: int, delay: float):
+        self.per_host = per_host
+        self.delay = delay
+        self._queues: dict[str, deque[str]] = {}
+        self._active: dict[str, int] = {}
+        self._last_hit: dict[str, float] = {}
+
+    def __bool__(self) -> bool:
+        return any(self._queues.values())
+
+    def push(self, url: str) -> None:
+        self._queues.setdefault(urlparse(url).netloc, deque()).append(url)
+
+    def _available(self, now: float) -> list[tuple[float, str]]:
+        """Returns (seconds until it may be hit, host) for every host with queued sitemaps and a free slot."""
+        return [
+            (max(0.0, self.delay - (now - self._last_hit.get(host, float("-inf")))), host)
+            for host, queue in self._queues.items()
+            if queue and self._active.get(host, 0) < self.per_host
+        ]
+
+    def pop_ready(self, now: float) -> str | None:
+        """Takes the next sitemap of the longest-idle host that may be hit right now, if any."""
+        ready = [host for wait, host in self._available(now) if wait == 0]
+        if not ready:
+            return None
+        host = min(ready, key=lambda host: self._last_hit.get(host, float("-inf")))
+        self._last_hit[host] = now
+        self._active[host] = self._active.get(host, 0) + 1
+        return self._queues[host].popleft()
+
+    def release(self, url: str) -> None:
+        """Frees the host slot taken by `url` once its fetch is over."""
+        self._active[urlparse(url).netloc] -= 1
+
+    def seconds_until_ready(self, now: float) -> float | None:
+        """Returns how long until some queued sitemap may be fetched, or None if all wait on a running fetch."""
+        return min((wait for wait, _ in self._available(now)), default=None)
+
+
+def _same_domain(base_netloc: str) -> Callable[[str], bool]:
+    """
+    Returns a check equivalent to urlparse(loc).netloc == base_netloc for http(s) URLs, made of plain
+    string prefix tests so that large sitemaps do not pay for a full URL parse per entry.
     """
+    roots = (f"https://{base_netloc}", f"http://{base_netloc}")
+    # The host must be followed by the path, query or fragment: "https://gym.pe.evil.com" is not on gym.pe
+    prefixes = tuple(root + separator for root in roots for separator in "/?#")
+    return lambda loc: loc.startswith(prefixes) or loc in roots
+
+
+class _SitemapCheckpoint:
+    """
+    Per-site record of the sitemaps already parsed, kept in the HTTP cache until the whole sitemap tree
+    has been fetched. A run that dies halfway through a large index resumes where it stopped instead of
+    downloading everything again; once a run completes the record is dropped, so the next one starts fresh.
+    Records older than `CHECKPOINT_TTL_SECONDS` (left behind by a run that was never resumed) are evicted
+    instead of trusted. Without a cache this does nothing.
+    """
+
+    def __init__(self, cache: ExtractionCache | None, base_url: str):
+        self.cache = cache
+        self.base_url = base_url
+
+    def _key(self, s_url: str) -> str:
+        return hashlib.sha256(f"checkpoint\0{self.base_url}\0{s_url}".encode("utf-8")).hexdigest()
+
+    def load(self, s_url: str) -> tuple[list[SitemapEntry], list[str], int] | None:
+        done = self.cache.get(self._key(s_url)) if self.cache is not None else None
+        if not done:
+            return None
+        if time.time() - done.get("saved_at", 0) > CHECKPOINT_TTL_SECONDS:
+            log.info("  -> Ignoring stale checkpoint for %s", s_url)
+            self.cache.evict(self._key(s_url))
+            return None
+        return [SitemapEntry(*fields) for fields in done["entries"]], done["children"], done["total_entries"]
+
+    def save(self, s_url: str, entries: list[SitemapEntry], children: list[str], total_entries: int) -> None:
+        if self.cache is not None:
+            self.cache.put(self._key(s_url), {
+                "entries": [(e.loc, e.lastmod, e.changefreq, e.priority) for e in entries],
+                "children": children,
+                "total_entries": total_entries,
+                "saved_at": time.time(),
+            }, {"base_url": self.base_url, "url": s_url})
+
+    def clear(self, s_urls: list[str]) -> None:
+        if self.cache is not None:
+            for s_url in s_urls:
+                self.cache.evict(self._key(s_url))
+
+
+async def _fetch_sitemap(client: httpx.AsyncClient, s_url: str, in_domain: Callable[[str], bool],
+                         cache: ExtractionCache | None) -> tuple[list[SitemapEntry], list[str], int] | None:
+    """
+    Fetches and parses one sitemap. Returns its entries on the base domain, the child sitemaps it
+    lists (when it is a sitemap index) and how many <url> entries it had in total, or None if the
+    sitemap could not be downloaded.
+    """
+    entries, children, total_entries = [], [], 0
+    # changefreq and priority take a handful of distinct values: every entry shares one str per value
+    shared_values: dict[str, str] = {}
+    log.info("  -> Processing %s...", s_url)
     try:
-        base_netloc = urlparse(base_url).netloc
-        robots_url = urljoin(base_url, "/robots.txt")
-
-        with httpx.Client(follow_redirects=True, timeout=15.0) as client:
-            # 1️⃣ Fetch robots.txt
-            logging.info(f"🔍 Fetching {robots_url}...")
-            response = client.get(robots_url)
-            if response.status_code != 200:
-                logging.warning(f"⚠️ Could not fetch robots.txt (Status: {response.status_code}).")
-                return []
-
-            # Find all sitemap URLs
+        # Streaming parse: each <url>/<sitemap> is handled while the rest is still downloading
+        async with _conditional_stream(client, s_url, cache) as (status_code, chunks):
+            if status_code != 200:
+                return None
+            async for elem in _iter_sitemap_elements(_gunzip(chunks)):
+                fields = _entry_fields(elem)
+                loc = fields[0]
+                if not loc:
+                    continue
+
+                # Handle sitemap index
+                if elem.tag == _SITEMAP_TAG:
+                    children.append(loc)
+
+                # Handle regular URL set, keeping only entries of the base domain
+                else:
+                    total_entries += 1
+                    if in_domain(loc):
+                        loc, lastmod, changefreq, priority = fields
+                        entries.append(SitemapEntry(
+                            loc,
+                            lastmod,
+                            shared_values.setdefault(changefreq, changefreq),
+                            shared_values.setdefault(priority, priority),
+                        ))
+
+    except etree.XMLSyntaxError:
+        log.error("  ⚠️ Failed to parse XML from %s", s_url)
+    except zlib.error as e:
+        # A corrupt .gz only loses this sitemap, not the whole crawl
+        log.error("  ⚠️ Failed to decompress %s: %s", s_url, e)
+    return entries, children, total_entries
+
+
+async def _iter_entry_batches(base_url: str, cache: ExtractionCache | None,
+                              max_concurrency: int) -> AsyncIterator[list[SitemapEntry]]:
+    """
+    Core of `iter_filtered_sitemap_urls`: yields the new unique entries of the base domain in batches,
+    as soon as every sitemap before them in sitemap order has been parsed. Raises httpx.RequestError
+    if a download fails.
+    """
+    base_netloc = urlparse(base_url).netloc
+    robots_url = urljoin(base_url, "/robots.txt")
+
+    async with httpx.AsyncClient(follow_redirects=True, timeout=15.0, http2=True, limits=_HTTP_LIMITS) as client:
+        # 1️⃣ Fetch robots.txt, picking up its Sitemap directives line by line as it downloads
+        log.info("🔍 Fetching %s...", robots_url)
+        async with _conditional_stream(client, robots_url, cache) as (status_code, chunks):
+            if status_code != 200:
+                log.warning("⚠️ Could not fetch robots.txt (Status: %s).", status_code)
+                return
             sitemap_urls = [
-                line.split(":", 1)[1].strip()
-                for line in response.text.splitlines()
-                if line.strip().lower().startswith("sitemap:")
+                match.group(1) async for line in _iter_lines(chunks)
+                if (match := _SITEMAP_LINE.match(line))
             ]
-            if not sitemap_urls:
-                logging.warning("⚠️ No sitemap URL found in robots.txt.")
-                return []
 
-            logging.info(f"✅ Found sitemap(s): {sitemap_urls}")
+        if not sitemap_urls:
+            log.warning("⚠️ No sitemap URL found in robots.txt.")
+            return
+
+        log.info("✅ Found sitemap(s): %s", sitemap_urls)
 
-            # 2️⃣ Process sitemap(s)
-            urls_to_process = sitemap_urls
-            all_page_entries = []
+        # 2️⃣ Process sitemap(s): a new fetch starts as soon as a slot frees up, up to max_concurrency at a time
+        in_domain = _same_domain(base_netloc)
+        loop = asyncio.get_running_loop()
+        urls_to_process = _HostFrontier(MAX_CONCURRENT_FETCHES_PER_HOST, HOST_FETCH_DELAY)
+        in_flight: dict[asyncio.Task, str] = {}
+        # Every sitemap is fetched once, even if several indexes list it (or an index lists itself)
+        visited = set()
+        results: dict[str, tuple[list[SitemapEntry], list[str]]] = {}
+        parsed_sitemaps = []
+        total_entries = domain_entries = 0
+        checkpoint = _SitemapCheckpoint(cache, base_url)
 
-            ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+        def record(s_url: str, entries: list[SitemapEntry], children: list[str], sitemap_total: int) -> None:
+            nonlocal total_entries, domain_entries
+            results[s_url] = entries, children
+            parsed_sitemaps.append(s_url)
+            total_entries += sitemap_total
+            domain_entries += len(entries)
+            for child in children:
+                visit(child)
 
-            while urls_to_process:
-                s_url = urls_to_process.pop(0)
-                logging.info(f"  -> Processing {s_url}...")
-                s_response = client.get(s_url)
-                if s_response.status_code != 200:
+        def visit(s_url: str) -> None:
+            if s_url in visited:
+                return
+            visited.add(s_url)
+            # A sitemap parsed by an interrupted previous run is replayed instead of fetched again
+            resumed = checkpoint.load(s_url)
+            if resumed is None:
+                urls_to_process.push(s_url)
+            else:
+                log.info("  -> Resuming %s from checkpoint", s_url)
+                record(s_url, *resumed)
+
+        # 3️⃣ Emit entries walking the sitemap tree breadth-first from the robots.txt sitemaps, so they come
+        # out in the same order whatever order the fetches finish in. The walk stops at the first sitemap
+        # still being fetched; parsed sitemaps are released as soon as they have been walked.
+        seen = set()
+        walk = deque(dict.fromkeys(sitemap_urls))
+        walked = set(walk)
+
+        def walk_ready() -> list[SitemapEntry]:
+            batch = []
+            while walk and walk[0] in results:
+                entries, children = results.pop(walk.popleft())
+                for entry in entries:
+                    if entry.loc not in seen:
+                        seen.add(entry.loc)
+                        batch.append(entry)
+                for child in children:
+                    if child not in walked:
+                        walked.add(child)
+                        walk.append(child)
+            return batch
+
+        for s_url in sitemap_urls:
+            visit(s_url)
+
+        try:
+            while urls_to_process or in_flight:
+                now = loop.time()
+                while len(in_flight) < max_concurrency and (s_url := urls_to_process.pop_ready(now)):
+                    in_flight[asyncio.create_task(_fetch_sitemap(client, s_url, in_domain, cache))] = s_url
+                # Wake up on the first finished fetch, or when a waiting host may be hit again
+                timeout = urls_to_process.seconds_until_ready(now) if len(in_flight) < max_concurrency else None
+                if not in_flight:
+                    await asyncio.sleep(timeout)
                     continue
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    s_url = in_flight.pop(task)
+                    urls_to_process.release(s_url)
+                    result = task.result()
+                    if result is None:
+                        results[s_url] = [], []
+                    else:
+                        checkpoint.save(s_url, *result)
+                        record(s_url, *result)
+                if batch := walk_ready():
+                    yield batch
+        finally:
+            for task in in_flight:
+                task.cancel()
+        checkpoint.clear(parsed_sitemaps)
+        if batch := walk_ready():
+            yield batch
 
-                try:
-                    root = ET.fromstring(s_response.content)
-
-                    # Handle sitemap index
-                    if root.tag.endswith("sitemapindex"):
-                        for sitemap in root.findall("sm:sitemap", ns):
-                            loc = sitemap.find("sm:loc", ns)
-                            if loc is not None:
-                                urls_to_process.append(loc.text.strip())
-
-                    # Handle regular URL set
-                    elif root.tag.endswith("urlset"):
-                        for url_entry in root.findall("sm:url", ns):
-                            loc = url_entry.find("sm:loc", ns)
-                            if loc is not None:
-                                entry = {
-                                    "loc": loc.text.strip(),
-                                    "lastmod": None,
-                                    "changefreq": None,
-                                    "priority": None,
-                                }
-
-                                lastmod = url_entry.find("sm:lastmod", ns)
-                                changefreq = url_entry.find("sm:changefreq", ns)
-                                priority = url_entry.find("sm:priority", ns)
-
-                                if lastmod is not None:
-                                    entry["lastmod"] = lastmod.text.strip()
-                                if changefreq is not None:
-                                    entry["changefreq"] = changefreq.text.strip()
-                                if priority is not None:
-                                    entry["priority"] = priority.text.strip()
-
-                                all_page_entries.append(entry)
-
-                except ET.ParseError:
-                    logging.error(f"  ⚠️ Failed to parse XML from {s_url}")
-
-            # 3️⃣ Filter by base domain
-            logging.info(f"Found {len(all_page_entries)} total entries. Filtering for domain '{base_netloc}'...")
-            filtered_entries = [
-                e for e in all_page_entries
-                if urlparse(e["loc"]).netloc == base_netloc
-            ]
+        log.info("Found %s total entries, %s for domain '%s'.", total_entries, domain_entries, base_netloc)
+        log.info("✅ Returning %s URLs with metadata.", len(seen))
 
-            # Deduplicate
-            seen = set()
-            unique_entries = []
-            for e in filtered_entries:
-                if e["loc"] not in seen:
-                    seen.add(e["loc"])
-                    unique_entries.append(e)
 
-            logging.info(f"✅ Returning {len(unique_entries)} URLs with metadata.")
-            return unique_entries
+async def get_filtered_sitemap_urls_async(base_url: str, cache: ExtractionCache | None = None,
+                                          max_concurrency: int = MAX_CONCURRENT_SITEMAP_FETCHES) -> list[SitemapEntry]:
+    """
+    Finds the sitemap from a site's robots.txt, fetches all page URLs with their metadata
+    (lastmod, changefreq, priority), and returns a unique list filtered to the base domain.
+    Sitemaps are fetched concurrently, at most `max_concurrency` at a time.
+
+    Args:
+        base_url: The starting URL of the website (e.g., "https://bioritmo.com.pe").
+        cache: Optional on-disk cache; robots.txt and sitemaps are then revalidated with conditional
+            GETs instead of downloaded again on every run, and an interrupted run resumes from the
+            sitemaps it had already parsed.
+        max_concurrency: Maximum number of sitemaps downloaded at the same time.
 
+    Returns:
+        A list of `SitemapEntry` (loc, lastmod, changefreq, priority), in sitemap order. Empty if
+        any request fails.
+    """
+    try:
+        return [entry async for batch in _iter_entry_batches(base_url, cache, max_concurrency) for entry in batch]
     except httpx.RequestError as e:
-        logging.error(f"❌ An error occurred during the request: {e}")
+        log.error("❌ An error occurred during the request: %s", e)
         return []
 
 
+def get_filtered_sitemap_urls(base_url: str, cache: ExtractionCache | None = None) -> list[SitemapEntry]:
+    """Synchronous wrapper around `get_filtered_sitemap_urls_async`."""
+    return asyncio.run(get_filtered_sitemap_urls_async(base_url, cache))
+
+
+def iter_filtered_sitemap_urls(base_url: str, cache: ExtractionCache | None = None,
+                               max_concurrency: int = MAX_CONCURRENT_SITEMAP_FETCHES) -> Iterator[SitemapEntry]:
+    """
+    Lazy version of `get_filtered_sitemap_urls`: yields the same entries in the same order, batch by batch.
+    The event loop only runs while the next batch is being requested, so fetching pauses while the caller
+    works through a batch and resumes when it asks for more. A caller that stops early cancels the fetches
+    still pending. If a request fails, the error is logged and the iteration ends, but the entries already
+    yielded stay valid.
+    """
+    async def next_batch() -> list[SitemapEntry] | None:
+        return await anext(batches, None)
+
+    with asyncio.Runner() as runner:
+        batches = _iter_entry_batches(base_url, cache, max_concurrency)
+        try:
+            while (batch := runner.run(next_batch())) is not None:
+                yield from batch
+        except httpx.RequestError as e:
+            log.error("❌ An error occurred during the request: %s", e)
+        finally:
+            runner.run(batches.aclose())
+
+
+def write_jsonl(entries: Iterable[SitemapEntry], path: str | os.PathLike) -> int:
+    """
+    Writes sitemap entries to `path` as JSON Lines, one {"loc", "lastmod", "changefreq", "priority"}
+    object per line, and returns how many were written. Pairs with `iter_filtered_sitemap_urls` to
+    dump a large sitemap without holding it in memory.
+    """
+    count = 0
+    with open(path, "wb") as f:
+        for entry in entries:
+            f.write(_entry_json(entry))
+            f.write(b"\n")
+            count += 1
+    return count
+
+
 if __name__ == "__main__":
     # Example usage with the tricky bioritmo site
     target_site = "https://www.bioritmo.com.pe"
-    urls = get_filtered_sitemap_urls(target_site)
+    urls = list(itertools.islice(iter_filtered_sitemap_urls(target_site), 10))  # First 10 for brevity
 
     print("\n--- Filtered URLs ---")
     if urls:
-        for url in urls[:10]:  # Print first 10 for brevity
+        for url in urls:
             print(url)
     else:
         print("No URLs found.")
@@ -0,0 +1,108 @@
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from src.sitemap_utils import SitemapEntry
+
+# A keyword only counts when it is a whole path segment or a dash-separated word of one,
+# e.g. /sedes/miraflores or /clases-y-horarios, but not /blog/precioso-dia
+_SEGMENT = r"(?:^|[/\-_])(?:{})(?=$|[/\-_.])"
+
+CATEGORY_PATTERNS: dict[str, re.Pattern] = {
+    "locations": re.compile(_SEGMENT.format(
+        r"sedes?|gimnasios?|locales|locations?|ubicaci(?:o|ó)n(?:es)?|contacto|contact|contactanos|unidades?"
+        r"|academias?|donde-estamos|encuentranos"
+    ), re.IGNORECASE),
+    "pricing": re.compile(_SEGMENT.format(
+        r"precios?|tarifas?|planes|plans?|pricing|prices?|membres(?:i|í)as?|memberships?|matr(?:i|í)cula"
+        r"|inscripci(?:o|ó)n|promociones|promos?|ofertas?|planos|pre(?:c|ç)os|assinaturas?|paquetes|packs?"
+    ), re.IGNORECASE),
+    "schedules": re.compile(_SEGMENT.format(
+        r"horarios?|schedules?|calendario|calendar|timetable|agenda|reservas?|grade|hor(?:a|á)rios"
+    ), re.IGNORECASE),
+    "disciplines": re.compile(_SEGMENT.format(
+        r"disciplinas?|clases|classes|actividades|activities|modalidades|aulas|yoga|pilates|spinning|cycling"
+        r"|crossfit|barre|funcional|entrenamientos?|trainings?|servicios|services"
+    ), re.IGNORECASE),
+}
+
+# Articles can mention any keyword (/blog/clases-de-yoga), so paths under a blog/news/post/tag
+# segment are never keyword-categorized and are left to the LLM instead
+_ARTICLE_PATH = re.compile(
+    r"(?:^|/)(?:blog|news|noticias|novedades|posts?|tags?|articulos?|articles?)(?=$|/)", re.IGNORECASE
+)
+
+
+# Query parameters that only defeat caches or track clicks; they never change what a page shows.
+# Short names such as v/t/version are left alone: they often pick the content (youtube watch?v=).
+CACHE_BUSTING_PARAMS = frozenset({"_", "cb", "cachebuster", "nocache", "fbclid", "gclid"})
+# Every utm_* parameter is tracking-only
+_TRACKING_PARAM_PREFIX = "utm_"
+
+# All categories folded into one alternation with a named group each, so a path is scanned once
+# instead of once per category. Keywords never belong to two categories, so no match is lost.
+_COMBINED_PATTERN = re.compile(
+    "|".join(f"(?P<{category}>{pattern.pattern})" for category, pattern in CATEGORY_PATTERNS.items()),
+    re.IGNORECASE,
+)
+# Bit i of a category mask is set when the path matched the i-th category of CATEGORY_PATTERNS
+CATEGORY_BITS: dict[str, int] = {category: 1 << i for i, category in enumerate(CATEGORY_PATTERNS)}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalizes a URL for deduplication: drops the fragment and cache-busting/tracking query
+    parameters, and lowercases the scheme and host.
+    """
+    parts = urlsplit(url)
+    query = urlencode([
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in CACHE_BUSTING_PARAMS and not key.lower().startswith(_TRACKING_PARAM_PREFIX)
+    ])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+
+def url_category_mask(path: str) -> int:
+    """
+    Returns the bitmask (see `CATEGORY_BITS`) of every category matched by the given URL path;
+    always 0 for article paths (see `_ARTICLE_PATH`).
+    """
+    if _ARTICLE_PATH.search(path):
+        return 0
+    mask = 0
+    for match in _COMBINED_PATTERN.finditer(path):
+        mask |= CATEGORY_BITS[match.lastgroup]
+    return mask
+
+
+def categorize_url_path(path: str) -> list[str]:
+    """Returns every category whose keyword pattern matches the given URL path."""
+    mask = url_category_mask(path)
+    return [category for category, bit in CATEGORY_BITS.items() if mask & bit]
+
+
+def fast_categorize_urls(urls: list[SitemapEntry]) -> tuple[dict[str, list[SitemapEntry]], list[SitemapEntry]]:
+    """
+    Categorizes URLs deterministically from Spanish/English/Portuguese keywords in their path.
+
+    Args:
+        urls: The sitemap entries to categorize.
+
+    Returns:
+        A tuple (categorized, ambiguous). `categorized` maps each category to the URLs whose path
+        matched it (high confidence). `ambiguous` holds URLs with a non-trivial path that matched
+        nothing, including blog/news articles; only those are worth sending to the LLM. URLs with
+        an empty path (the homepage) are in neither, since the caller always scrapes the homepage.
+    """
+    categorized = {category: [] for category in CATEGORY_BITS}
+    ambiguous = []
+    for url in urls:
+        path = urlsplit(url.loc).path.strip("/")
+        mask = url_category_mask(path)
+        if not mask:
+            if path:
+                ambiguous.append(url)
+            continue
+        for category, bit in CATEGORY_BITS.items():
+            if mask & bit:
+                categorized[category].append(url)
+    return categorized, ambiguous
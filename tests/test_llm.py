@@ -0,0 +1,108 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from src.cache_utils import ExtractionCache
+from src.llm import (
+    _JsonObjectAccumulator,
+    _categorization_cache_key,
+    _categorize_chunk,
+    _map_categorized_urls,
+    _parse_categorization,
+)
+from src.sitemap_utils import SitemapEntry
+
+URLS = [SitemapEntry(f"https://gym.com/p{i}") for i in range(3)]
+
+
+class FakeClient:
+    """Answers every chat completion with a fixed reply."""
+
+    def __init__(self, reply: str):
+        self.calls = 0
+
+        def create(**kwargs):
+            self.calls += 1
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))])
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+
+def feed_all(chunks: list[str]) -> tuple[bool, str]:
+    accumulator = _JsonObjectAccumulator()
+    closed = False
+    for chunk in chunks:
+        closed = accumulator.feed(chunk)
+        if closed:
+            break
+    return closed, accumulator.text()
+
+
+def test_accumulator_stops_at_the_closing_brace():
+    closed, text = feed_all(['{"a": {"b": 1}', '} trailing text', "never read"])
+    assert closed
+    assert json.loads(text) == {"a": {"b": 1}}
+
+
+@pytest.mark.parametrize("chunks", [
+    # Escaped quote split between chunks: the backslash ends one chunk, the quote starts the next
+    ['{"a": "say \\', '"}\\" {"', ', "b": 2}'],
+    # Braces inside strings do not count
+    ['{"a": "}}}{', '{", "b": 2}'],
+    # Escaped backslash right before the closing quote
+    ['{"a": "x\\\\', '", "b": 2}'],
+])
+def test_accumulator_handles_strings_and_split_escapes(chunks):
+    closed, text = feed_all(chunks)
+    assert closed
+    assert json.loads(text)["b"] == 2
+
+
+def test_accumulator_reports_an_unclosed_object():
+    closed, text = feed_all(['{"a": "unterminated }'])
+    assert not closed
+    assert text == '{"a": "unterminated }'
+
+
+def test_map_categorized_urls_drops_out_of_range_indices():
+    result = _map_categorized_urls({"locations": [0, 7, -1], "pricing": [2]}, URLS)
+    assert result == {"locations": [URLS[0]], "pricing": [URLS[2]], "schedules": [], "disciplines": []}
+
+
+@pytest.mark.parametrize("reply", [
+    '{"locations": [0], "pricing": null, "schedules": [], "disciplines": []}',
+    "[0, 1]",
+    '{"locations": ["first"]}',
+    "not json",
+])
+def test_parse_categorization_rejects_malformed_replies(reply):
+    with pytest.raises(ValidationError):
+        _parse_categorization(reply)
+
+
+def test_parse_categorization_fills_missing_categories():
+    assert _parse_categorization('{"locations": [1], "other": [2]}') == {
+        "locations": [1], "pricing": [], "schedules": [], "disciplines": []
+    }
+
+
+def test_categorize_chunk_skips_and_does_not_cache_a_malformed_reply(tmp_path):
+    cache = ExtractionCache(tmp_path)
+    client = FakeClient('{"locations": [0], "pricing": null}')
+
+    assert _categorize_chunk(URLS, client, cache) is None
+    assert cache.get(_categorization_cache_key(URLS)) is None
+
+
+def test_categorize_chunk_caches_a_valid_reply(tmp_path):
+    cache = ExtractionCache(tmp_path)
+    client = FakeClient('{"locations": [0], "disciplines": [1, 2]}')
+
+    result = _categorize_chunk(URLS, client, cache)
+    assert result["locations"] == [URLS[0]]
+    assert result["disciplines"] == [URLS[1], URLS[2]]
+    # The second call is served from the cache
+    assert _categorize_chunk(URLS, client, cache) == result
+    assert client.calls == 1
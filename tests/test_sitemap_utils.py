@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+import zlib
+
+import httpx
+import pytest
+
+from src import sitemap_utils
+from src.cache_utils import ExtractionCache
+from src.sitemap_utils import (
+    SITEMAP_NS,
+    SitemapEntry,
+    _SitemapCheckpoint,
+    _fetch_sitemap,
+    _gunzip,
+    _iter_sitemap_elements,
+)
+
+URLSET = (
+    f'<urlset xmlns="{SITEMAP_NS}">'
+    "<url><loc>https://gym.com/sedes</loc><lastmod>2025-01-01</lastmod></url>"
+    "<url><loc>https://gym.com/precios</loc><changefreq>weekly</changefreq></url>"
+    "<url><loc>https://other.com/x</loc></url>"
+    "</urlset>"
+).encode()
+
+
+async def chunked(body: bytes, size: int = 7):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+async def collect(chunks) -> list:
+    return [item async for item in chunks]
+
+
+def fetch(body: bytes) -> tuple[list[SitemapEntry], list[str], int] | None:
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body))
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await _fetch_sitemap(client, "https://gym.com/sitemap.xml.gz",
+                                        lambda loc: loc.startswith("https://gym.com"), None)
+
+    return asyncio.run(run())
+
+
+def test_iter_sitemap_elements_parses_split_chunks():
+    locs = asyncio.run(collect(
+        elem.findtext(f"{{{SITEMAP_NS}}}loc") async for elem in _iter_sitemap_elements(chunked(URLSET))
+    ))
+    assert locs == ["https://gym.com/sedes", "https://gym.com/precios", "https://other.com/x"]
+
+
+def test_gunzip_decompresses_and_passes_plain_bodies_through():
+    assert b"".join(asyncio.run(collect(_gunzip(chunked(gzip.compress(URLSET)))))) == URLSET
+    assert b"".join(asyncio.run(collect(_gunzip(chunked(URLSET))))) == URLSET
+
+
+def test_gunzip_raises_on_a_corrupt_body():
+    corrupt = gzip.compress(URLSET)[:10] + b"\xff" * 40
+    with pytest.raises(zlib.error):
+        asyncio.run(collect(_gunzip(chunked(corrupt))))
+
+
+def test_fetch_sitemap_keeps_base_domain_entries():
+    entries, children, total = fetch(gzip.compress(URLSET))
+    assert entries == [
+        SitemapEntry("https://gym.com/sedes", "2025-01-01"),
+        SitemapEntry("https://gym.com/precios", None, "weekly"),
+    ]
+    assert children == []
+    assert total == 3
+
+
+def test_fetch_sitemap_skips_a_corrupt_gzip():
+    assert fetch(gzip.compress(URLSET)[:10] + b"\xff" * 40) == ([], [], 0)
+
+
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint = _SitemapCheckpoint(ExtractionCache(tmp_path), "https://gym.com")
+    entries = [SitemapEntry("https://gym.com/sedes", "2025-01-01")]
+    checkpoint.save("https://gym.com/sitemap.xml", entries, ["https://gym.com/child.xml"], 5)
+
+    assert checkpoint.load("https://gym.com/sitemap.xml") == (entries, ["https://gym.com/child.xml"], 5)
+    checkpoint.clear(["https://gym.com/sitemap.xml"])
+    assert checkpoint.load("https://gym.com/sitemap.xml") is None
+
+
+def test_checkpoint_expires_after_the_ttl(tmp_path, monkeypatch):
+    cache = ExtractionCache(tmp_path)
+    checkpoint = _SitemapCheckpoint(cache, "https://gym.com")
+    checkpoint.save("https://gym.com/sitemap.xml", [SitemapEntry("https://gym.com/sedes")], [], 1)
+
+    saved_at = sitemap_utils.time.time()
+    monkeypatch.setattr(sitemap_utils.time, "time", lambda: saved_at + sitemap_utils.CHECKPOINT_TTL_SECONDS + 1)
+    assert checkpoint.load("https://gym.com/sitemap.xml") is None
+    # The stale record is evicted, not just skipped
+    assert cache.get(checkpoint._key("https://gym.com/sitemap.xml")) is None
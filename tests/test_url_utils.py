@@ -0,0 +1,49 @@
+import pytest
+
+from src.sitemap_utils import SitemapEntry
+from src.url_utils import CATEGORY_BITS, canonicalize_url, fast_categorize_urls, url_category_mask
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("HTTPS://Gym.COM/Sedes#mapa", "https://gym.com/Sedes"),
+    ("https://gym.com/w?utm_source=x&UTM_Campaign=y&fbclid=1&gclid=2&_=3&cb=4", "https://gym.com/w"),
+    # Short parameters such as v/t often pick the content, so they are kept
+    ("https://youtube.com/watch?v=abc&t=30", "https://youtube.com/watch?v=abc&t=30"),
+    ("https://gym.com/horarios?sede=surco&nocache=1", "https://gym.com/horarios?sede=surco"),
+])
+def test_canonicalize_url(url, expected):
+    assert canonicalize_url(url) == expected
+
+
+@pytest.mark.parametrize("path, categories", [
+    ("sedes/miraflores", {"locations"}),
+    ("clases-y-horarios", {"disciplines", "schedules"}),
+    ("planes/yoga", {"pricing", "disciplines"}),
+    ("blog/precioso-dia", set()),
+    ("nosotros", set()),
+    # Articles never count, whatever keywords they mention
+    ("blog/clases-de-yoga", set()),
+    ("es/noticias/nuevas-sedes", set()),
+    ("tag/pilates", set()),
+    ("blogger/yoga", {"disciplines"}),
+])
+def test_url_category_mask(path, categories):
+    mask = url_category_mask(path)
+    assert {category for category, bit in CATEGORY_BITS.items() if mask & bit} == categories
+
+
+def test_fast_categorize_urls_splits_categorized_and_ambiguous():
+    urls = [
+        SitemapEntry("https://gym.com/"),
+        SitemapEntry("https://gym.com/sedes/surco"),
+        SitemapEntry("https://gym.com/nosotros"),
+        SitemapEntry("https://gym.com/blog/clases-de-yoga"),
+        SitemapEntry("https://gym.com/precios"),
+    ]
+    categorized, ambiguous = fast_categorize_urls(urls)
+
+    assert categorized["locations"] == [urls[1]]
+    assert categorized["pricing"] == [urls[4]]
+    assert categorized["schedules"] == categorized["disciplines"] == []
+    # The homepage is in neither list
+    assert ambiguous == [urls[2], urls[3]]